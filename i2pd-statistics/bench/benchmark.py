@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Benchmark the parsing in i2pd-statistics.py
+#
+# Times the homepage and tunnels page parsers (with and without per-tunnel
+# details) against either captured pages or a generated tunnels page, and
+# compares the tunnels page parser against the line-by-line implementation
+# it replaced
+#
+#   ./benchmark.py --tunnels 20000 --iterations 20
+#   ./benchmark.py --tunnels-page captured-tunnels.html --homepage captured-home.html
+#
+# Pages can be captured with
+#
+#   curl -s 'http://localhost:7070/?page=tunnels' > captured-tunnels.html
+#
+# Licensed under BSD3, see LICENSE for full license text
+#
+
+import argparse
+import base64
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import time
+
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "i2pd-statistics.py")
+
+# The states a tunnel can be shown in, and how likely each is in a generated page
+# https://github.com/PurpleI2P/i2pd/blob/openssl/daemon/HTTPServer.cpp#L134
+tunnel_states = [
+    ("established", 0.8),
+    ("expiring", 0.1),
+    ("building", 0.05),
+    ("failed", 0.05)
+    ]
+
+
+def load_plugin():
+    ''' Import the plugin as a module
+    '''
+    spec = importlib.util.spec_from_file_location("i2pd_statistics", PLUGIN)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def generate_tunnels_page(count, seed):
+    ''' Generate a tunnels page listing count tunnels, split evenly between directions
+    '''
+    rand = random.Random(seed)
+    states = [x[0] for x in tunnel_states]
+    weights = [x[1] for x in tunnel_states]
+
+    def listitem(direction):
+        state = rand.choices(states, weights)[0]
+        hops = "".join([" &#8658; {}".format(base64.b64encode(rand.getrandbits(24).to_bytes(3, "big")).decode())
+                        for i in range(rand.randint(0, 4))])
+        if direction == "inbound":
+            path = "{} &#8658; {}:me".format(hops, rand.getrandbits(32))
+        else:
+            path = "{}:me{} &#8658; ".format(rand.getrandbits(32), hops)
+
+        # i2pd only shows latency once it's been measured
+        latency = ""
+        if rand.random() < 0.7:
+            latency = " ( {}ms )".format(int(rand.lognormvariate(6.5, 0.5)))
+
+        exploratory = " (exploratory)" if rand.random() < 0.2 else ""
+        # Matches i2pd's markup: there's no space between the path (or
+        # latency) and the state's span
+        return ('<div class="listitem">{path}{latency}'
+                '<span class="tunnel {state}"> {state}{exploratory}</span>, '
+                ' <span class="sent">{kib} KiB</span>\r\n</div>').format(
+                    path = path,
+                    latency = latency,
+                    state = state,
+                    exploratory = exploratory,
+                    kib = round(rand.random() * 1000, 2)
+                    )
+
+    page = ['<html><body><div class="content">',
+            '<b>Queue size:</b> 0<br>',
+            '<b>Inbound tunnels:</b><br>\r\n<div class="list">']
+    page += [listitem("inbound") for i in range(count // 2)]
+    page += ['</div><br>', '<b>Outbound tunnels:</b><br>\r\n<div class="list">']
+    page += [listitem("outbound") for i in range(count - count // 2)]
+    page += ['</div><br>', '</div></body></html>']
+    return "\r\n".join(page)
+
+
+def legacy_process_tunnels_page(tunnels_page):
+    ''' The tunnels page parser that process_tunnels_page() replaced
+
+    Kept here so that the two can be compared for speed and correctness
+    '''
+    page_split = tunnels_page.split("<b>Outbound tunnels:</b>")
+    result = []
+    for section in page_split:
+        counts = {
+            "tunnels" : 0,
+            "expiring" : 0,
+            "established" : 0,
+            "exploring" : 0,
+            "building" : 0,
+            "failed" : 0
+            }
+        for line in section.split("\n"):
+            if line.startswith('<div class="listitem">'):
+                counts['tunnels'] += 1
+                if "tunnel expiring" in line:
+                    counts['expiring'] += 1
+                elif "tunnel building" in line:
+                    counts['building'] += 1
+                elif "tunnel failed" in line:
+                    counts['failed'] += 1
+                elif "tunnel established" in line:
+                    counts['established'] += 1
+                    if "(exploratory)" in line:
+                        counts['exploring'] += 1
+        result.append(counts)
+
+    return result[0], result[1]
+
+
+def run_timed(func, arg, iterations):
+    ''' Call func(arg) iterations times, returning the result and the per-call timings in ms
+    '''
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        res = func(arg)
+        timings.append((time.perf_counter() - start) * 1000)
+    return res, timings
+
+
+def report(name, timings):
+    print("{:<28} mean={:>9.3f}ms  median={:>9.3f}ms  min={:>9.3f}ms  max={:>9.3f}ms".format(
+        name,
+        statistics.mean(timings),
+        statistics.median(timings),
+        min(timings),
+        max(timings)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark i2pd-statistics page parsing")
+    parser.add_argument("--tunnels-page", help="Captured tunnels page to parse (default: generate one)")
+    parser.add_argument("--homepage", help="Captured homepage to parse")
+    parser.add_argument("--tunnels", type=int, default=20000, help="Number of tunnels in a generated page")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+
+    if args.tunnels_page:
+        with open(args.tunnels_page, "r") as f:
+            tunnels_page = f.read()
+    else:
+        tunnels_page = generate_tunnels_page(args.tunnels, args.seed)
+
+    print("Tunnels page: {:.2f} MiB".format(len(tunnels_page.encode()) / 1048576))
+
+    new, new_timings = run_timed(plugin.process_tunnels_page, tunnels_page, args.iterations)
+    old, old_timings = run_timed(legacy_process_tunnels_page, tunnels_page, args.iterations)
+    report("process_tunnels_page", new_timings)
+    report("legacy", old_timings)
+    print("Speedup: {:.2f}x".format(statistics.median(old_timings) / statistics.median(new_timings)))
+
+    # Latency quantiles and hop counts come from a different tokenizer
+    def with_details(page):
+        details = {"inbound" : plugin.new_tunnel_details(), "outbound" : plugin.new_tunnel_details()}
+        return plugin.process_tunnels_page(page, details), details
+    (detailed, details), timings = run_timed(with_details, tunnels_page, args.iterations)
+    report("with tunnel details", timings)
+    for direction in details:
+        sketch = details[direction]["latency"]
+        print("  {:<9} latency p50={} p90={} p99={} max={} ({} samples), hops={}".format(
+            direction,
+            sketch.quantile(0.5),
+            sketch.quantile(0.9),
+            sketch.quantile(0.99),
+            sketch.max,
+            sketch.count,
+            details[direction]["hops"]
+            ))
+
+    if args.homepage:
+        with open(args.homepage, "r") as f:
+            homepage = f.read()
+        stats, timings = run_timed(plugin.process_homepage, homepage, args.iterations)
+        report("process_homepage", timings)
+
+    if new != old or detailed != old:
+        print("Mismatch between parsers:\n  new: {}\n  detailed: {}\n  old: {}".format(new, detailed, old))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
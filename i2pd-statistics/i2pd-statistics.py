@@ -6,34 +6,367 @@
 #
 # From https://github.com/bentasker/telegraf-plugins/tree/master/i2pd-statistics
 
+import json
+import math
 import os
 import re
 import requests
 import sys
+import tempfile
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 HOST = os.getenv('I2PD_CONSOLE', 'http://localhost:7070')
 MEASUREMENT = os.getenv('I2PD_MEASUREMENT', 'i2pd')
 
+# Timeout (in seconds) for requests to the webconsole and I2PControl
+TIMEOUT = float(os.getenv('I2PD_TIMEOUT', 10))
+
+# Where to get the main stats from: html (scrape the webconsole) or
+# jsonrpc (use the I2PControl API, falling back to html if that fails)
+BACKEND = os.getenv('I2PD_BACKEND', 'html')
+
+# I2PControl connection info
+CONTROL_URL = os.getenv('I2PD_CONTROL_URL', 'https://127.0.0.1:7650/')
+CONTROL_PASSWORD = os.getenv('I2PD_CONTROL_PASSWORD', 'itoopie')
+# I2PControl uses a self-signed certificate by default
+CONTROL_VERIFY = os.getenv('I2PD_CONTROL_VERIFY', 'false').lower() == "true"
+
+# Whether to report per-tunnel latency quantiles and hop counts from the tunnels page
+TUNNEL_DETAILS = os.getenv('I2PD_TUNNEL_DETAILS', 'true').lower() == "true"
+
+# Whether to collect per-transport session stats from the transports page
+TRANSPORT_STATS = os.getenv('I2PD_TRANSPORT_STATS', 'false').lower() == "true"
+
+# Sessions which have transferred more than this many bytes (sent + received)
+# are counted as large
+TRANSPORT_LARGE_BYTES = int(os.getenv('I2PD_TRANSPORT_LARGE_BYTES', 10485760))
+
+# Used to persist things (like the I2PControl token) between runs
+STATE_FILE = os.getenv('I2PD_STATE_FILE', os.path.join(tempfile.gettempdir(), 'i2pd-statistics.state'))
+
+# The I2PControl RouterInfo keys we request, and the stats they map to
+# https://geti2p.net/en/docs/api/i2pcontrol
+rpc_keys = {
+    "i2p.router.uptime" : "uptime",
+    "i2p.router.version" : "version",
+    "i2p.router.net.status" : "network_status",
+    "i2p.router.net.tunnels.successrate" : "creation_success",
+    "i2p.router.net.total.received.bytes" : "in_vol",
+    "i2p.router.net.total.sent.bytes" : "out_vol",
+    "i2p.router.net.bw.inbound.15s" : "in_15s_through",
+    "i2p.router.net.bw.outbound.15s" : "out_15s_through",
+    "i2p.router.netdb.knownpeers" : "routers",
+    "i2p.router.netdb.activepeers" : "active_peers",
+    "i2p.router.net.tunnels.participating" : "transittunnels"
+    }
+
+# i2pd's RouterStatus enum, as returned by i2p.router.net.status
+# https://github.com/PurpleI2P/i2pd/blob/openssl/libi2pd/RouterContext.h
+#
+# This is the enum in current releases. Older releases also had Testing and
+# Error values, shifting the codes, so the raw code is written out too
+rpc_net_status = {
+    0 : "OK",
+    1 : "Firewalled",
+    2 : "Unknown",
+    3 : "Proxy",
+    4 : "Mesh"
+    }
+
+# Fields in the main line of output and the stats they come from
+main_fields = [
+    # field, stat, type
+    ["uptime", "uptime", "int"],
+    ["tunnel_creation_success_rate", "creation_success", "float"],
+    ["in_bytes", "in_vol", "int"],
+    ["in_avg_bps", "in_through", "float"],
+    ["out_bytes", "out_vol", "int"],
+    ["out_avg_bps", "out_through", "float"],
+    ["transit_bytes", "transit_vol", "int"],
+    ["transit_avg_bps", "transit_through", "float"],
+    ["in_15s_bps", "in_15s_through", "float"],
+    ["out_15s_bps", "out_15s_through", "float"],
+    ["routers", "routers", "int"],
+    ["active_peers", "active_peers", "int"],
+    ["network_status_code", "network_status_code", "int"],
+    ["floodfills", "floodfills", "int"],
+    ["leasesets", "leasesets", "int"],
+    ["clienttunnels", "clienttunnels", "int"],
+    ["transittunnels", "transittunnels", "int"],
+    ["in_bps", "in_rate", "float"],
+    ["out_bps", "out_rate", "float"],
+    ["transit_bps", "transit_rate", "float"],
+    ["rate_interval", "rate_interval", "float"],
+    ["fetch_skew_ms", "fetch_skew_ms", "float"]
+    ]
+
+# Byte counters that we derive per-interval rates from, and the stat to write the rate into
+rate_counters = {
+    "in_vol" : "in_rate",
+    "out_vol" : "out_rate",
+    "transit_vol" : "transit_rate"
+    }
+
+# Patterns used when parsing the webconsole, compiled once rather than on every call
+bold_field_re = re.compile(r"<b>(.+)<br>")
+# Uptime units and their length in seconds. The patterns match both the
+# singular and plural (i2pd writes "1 day, 1 hour, 2 minutes, 1 second")
+uptime_units = {"day" : 86400, "hour" : 3600, "minute" : 60, "second" : 1}
+uptime_res = { unit : re.compile(r"([0-9]+) {}".format(unit)) for unit in uptime_units }
+percentage_re = re.compile(r"([0-9,\.]+)%")
+number_re = re.compile(r"([0-9]+)")
+volume_res = { unit : re.compile(r"([0-9,\.]+) {} ".format(unit)) for unit in ["KiB", "MiB", "GiB"] }
+throughput_re = re.compile(r"([0-9,\.]+) KiB/s")
+version_re = re.compile(r"([0-9,\.]+)")
+
+# Tokenizer for the tunnels page. Each tunnel's listitem contains a span like
+#
+#   <span class="tunnel established"> established (exploratory)</span>
+#
+# a match captures the state and whether there's an (exploratory) suffix.
+# The pattern needs to start with a literal: that lets the regex engine skip
+# quickly through the page, an alternation makes it several times slower
+#
+# Status strings can be seen here https://github.com/PurpleI2P/i2pd/blob/openssl/daemon/HTTPServer.cpp#L134
+tunnel_state_re = re.compile(r'tunnel (\w+)"> [^<(]*(\()?')
+
+# Tunnel states that we report counts for
+tunnel_states = {"expiring", "established", "building", "failed"}
+
+# Tokenizer used when we also want per-tunnel details. A tunnel's listitem
+# looks like
+#
+#   <div class="listitem"> &#8658; AbCd &#8658; EfGh &#8658; 1234:me ( 412ms )<span class="tunnel ...
+#
+# (outbound tunnels have "me" at the start instead). There's an arrow either side
+# of each hop, so the hop count is the number of arrows minus one. Latency is
+# only shown once i2pd has measured it. A match captures the path, latency, 
+# state and (exploratory) suffix, so a tunnel is fully handled in one match
+tunnel_detail_re = re.compile(r'<div class="listitem">([^<(]*)(?:\( ([0-9]+)[^)]*\)\s*)?<span class="tunnel (\w+)"> [^<(]*(\()?')
+hop_separator = "&#8658;"
+
+# Tunnels have at most 8 hops, anything above this is counted in the top bucket
+max_hops = 8
+
+# Relative accuracy of the latency quantiles, and the highest latency (ms) we
+# keep resolution for. Together these fix the sketch's size
+latency_accuracy = 0.01
+latency_max_ms = 60000
+
+# The transports page has a collapsible section per transport and IP family,
+# each headed by a label like
+#
+#   <label for="slide_ntcp2v6">NTCP2v6 ( 12 )</label>
+#
+# Sessions within a section look like
+#
+#   <div class="listitem">\r\n &#8658; AbCd: 192.0.2.1:12345 [1024:2048]
+#
+# The arrow comes first for outbound sessions, and the counters are bytes sent:received.
+# IPv6 addresses are wrapped in square brackets, so we have to skip past those
+#
+# https://github.com/PurpleI2P/i2pd/blob/openssl/daemon/HTTPServer.cpp
+transport_section_re = re.compile(r'<label for="slide_(\w+)">')
+transport_session_re = re.compile(r'<div class="listitem">\s*(&#8658;)?[^\[<]*(?:\[[0-9a-fA-F:.]*\][^\[<]*)?\[([0-9]+):([0-9]+)\]')
+
+# Pages are fetched in parallel, so we want enough pooled
+# keep-alive connections for all of them to be in flight at once
+SESSION = requests.Session()
+SESSION.mount("http://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=3))
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=3))
+
 def getPage(path,host):
     
-    r = requests.get("{}{}".format(host, path))
+    r = SESSION.get("{}{}".format(host, path), timeout=TIMEOUT)
     return r.text
+
+
+def getTimedPage(path, host):
+    ''' Fetch a page, also returning the time at which the read completed
+    '''
+    text = getPage(path, host)
+    return text, time.time()
+
+
+def getTimedRpcStats(state):
+    ''' Fetch stats from I2PControl, also returning the time at which the read completed
+    '''
+    stats = fetch_rpc_stats(state)
+    return stats, time.time()
+
+
+def fetchPages(state):
+    ''' Fetch the main stats and the tunnels page
+    
+    The two are fetched in parallel so that the snapshots are as close 
+    together as possible. 
     
+    If enabled, the transports page is fetched alongside them. A failure
+    to fetch it isn't treated as fatal
+    
+    Returns a tuple: stats (False if I2PControl wasn't used), 
+    homepage (False if it wasn't fetched), tunnels page, the
+    skew between the two snapshots in milliseconds and the transports
+    page (False if it wasn't fetched)
+    '''
+    stats = False
+    homepage = False
+    transports_page = False
+    transports_fut = False
+    
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        tunnels_fut = executor.submit(getTimedPage, "/?page=tunnels", HOST)
+        if TRANSPORT_STATS:
+            transports_fut = executor.submit(getPage, "/?page=transports", HOST)
+        if BACKEND == "jsonrpc":
+            main_fut = executor.submit(getTimedRpcStats, state)
+        else:
+            main_fut = executor.submit(getTimedPage, "/", HOST)
+            
+        tunnels_page, tunnels_ts = tunnels_fut.result()
+        
+        try:
+            main, main_ts = main_fut.result()
+        except Exception:
+            if BACKEND != "jsonrpc":
+                raise
+            main = False
+            
+    if BACKEND == "jsonrpc" and main:
+        stats = main
+    elif BACKEND == "jsonrpc":
+        # Fall back to scraping
+        homepage, main_ts = getTimedPage("/", HOST)
+    else:
+        homepage = main
+        
+    if transports_fut:
+        try:
+            transports_page = transports_fut.result()
+        except Exception:
+            transports_page = False
+            
+    return stats, homepage, tunnels_page, round(abs(tunnels_ts - main_ts) * 1000, 3), transports_page
+    
+
+def loadState():
+    ''' Load the state persisted by previous runs
+    '''
+    try:
+        with open(STATE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+    
+    
+def saveState(state):
+    ''' Persist state for the next run
+    
+    The state can include the I2PControl token, so it's written via a
+    temporary file that mkstemp() creates: that's only readable by us, 
+    and can't be a file or link that someone else created first
+    '''
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(STATE_FILE)))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, STATE_FILE)
+    except OSError:
+        os.unlink(tmp)
+
+
+def rpcRequest(method, params):
+    ''' Place a request to the I2PControl JSON-RPC API
+    
+    Returns the result, or raises RuntimeError if the API returned an error
+    (with the error code as the second arg)
+    '''
+    req = {
+        "jsonrpc" : "2.0",
+        "id" : 1,
+        "method" : method,
+        "params" : params
+        }
+    r = SESSION.post(CONTROL_URL, json=req, verify=CONTROL_VERIFY, timeout=TIMEOUT)
+    resp = r.json()
+    if "error" in resp:
+        raise RuntimeError(resp["error"].get("message", "unknown error"), resp["error"].get("code", 0))
+    return resp["result"]
+
+
+def rpcAuthenticate():
+    ''' Log into I2PControl and return a token
+    '''
+    res = rpcRequest("Authenticate", {"API" : 1, "Password" : CONTROL_PASSWORD})
+    return res["Token"]
+
+
+def fetch_rpc_stats(state):
+    ''' Fetch stats through the I2PControl API with a single RouterInfo call
+    
+    The token is cached in state, we only re-authenticate if it's been rejected
+    
+    Returns a stats dict, see process_homepage()
+    '''
+    if not CONTROL_VERIFY:
+        requests.packages.urllib3.disable_warnings()
+        
+    params = { k : "" for k in rpc_keys }
+    for attempt in range(2):
+        if not state.get("token"):
+            state["token"] = rpcAuthenticate()
+            
+        params["Token"] = state["token"]
+        try:
+            res = rpcRequest("RouterInfo", params)
+            break
+        except RuntimeError as e:
+            # -32002 to -32004 are missing, unknown or expired tokens
+            if attempt > 0 or e.args[1] not in [-32002, -32003, -32004]:
+                raise
+            state["token"] = False
+            
+    stats = {}
+    for k in rpc_keys:
+        if k in res and res[k] is not None:
+            stats[rpc_keys[k]] = res[k]
+            
+    # Normalise to match what we'd have got from the webconsole
+    if "uptime" in stats:
+        # ms -> s
+        stats["uptime"] = int(stats["uptime"]) // 1000
+    if "network_status" in stats:
+        stats["network_status_code"] = int(stats["network_status"])
+        stats["network_status"] = rpc_net_status.get(stats["network_status_code"], "Unknown")
+    for k in ["in_15s_through", "out_15s_through"]:
+        # Bytes/s -> bit/s
+        if k in stats:
+            stats[k] = float(stats[k]) * 8
+            
+    return stats
+
 
 def getMatches(inp, regex):
-    return re.findall(regex, inp)
+    ''' Return all matches of a precompiled pattern
+    '''
+    return regex.findall(inp)
     
 def process_uptime(inp):
-    ''' Convert x hours, y minutes, z seconds to seconds
+    ''' Convert w days, x hours, y minutes, z seconds to seconds
+    
+    i2pd leaves out any leading units which are 0
     '''
-    res = {}
-    for unit in ["hours", "minutes", "seconds"]:
-        res[unit] = getMatches(inp, "([0-9]+) {}".format(unit))
-        if len(res[unit]) == 0:
-            res[unit] = ['0']        
-
-    # Convert to seconds
-    seconds = (int(res["hours"][0]) * 3600) + (int(res["minutes"][0]) * 60) + int(res["seconds"][0])
+    seconds = 0
+    for unit in uptime_units:
+        res = getMatches(inp, uptime_res[unit])
+        if len(res) > 0:
+            seconds += int(res[0]) * uptime_units[unit]
+
     return seconds
     
 def process_netstatus(inp):
@@ -47,7 +380,7 @@ def process_percentage(inp):
     ''' Extract a percentage value
     '''
     
-    perc = getMatches(inp, "([0-9,\.]+)%")
+    perc = getMatches(inp, percentage_re)
     if len(perc) == 0:
         return 0
     else:
@@ -57,7 +390,7 @@ def process_percentage(inp):
 def extract_number(inp):
     ''' Extract an integer
     '''
-    i = getMatches(inp, "([0-9]+)")    
+    i = getMatches(inp, number_re)
     if len(i) == 0:
         i = ["0"]
         
@@ -71,13 +404,13 @@ def extract_throughput(inp):
     '''
     
     unit = "KiB"
-    volume = getMatches(inp, "([0-9,\.]+) KiB ")
+    volume = getMatches(inp, volume_res["KiB"])
     if len(volume) == 0:
         unit = "MiB"
-        volume = getMatches(inp, "([0-9,\.]+) MiB ")
+        volume = getMatches(inp, volume_res["MiB"])
         if len(volume) == 0:
-            unit = "MiB"
-            volume = getMatches(inp, "([0-9,\.]+) GiB ")
+            unit = "GiB"
+            volume = getMatches(inp, volume_res["GiB"])
     
     # We _should_ now have a volume - it needs converting to bytes
     if unit == "KiB":
@@ -89,7 +422,7 @@ def extract_throughput(inp):
     
     # Now we need to do the same to extract calculated throughput
     # that's always kibibits (https://github.com/PurpleI2P/i2pd/blob/openssl/daemon/HTTPServer.cpp#L289)
-    throughp = getMatches(inp, "([0-9,\.]+) KiB/s")
+    throughp = getMatches(inp, throughput_re)
     if len(throughp) == 0:
         throughp = ['0']
     
@@ -104,7 +437,7 @@ def extract_throughput(inp):
 def extract_version(inp):
     ''' Extract the version string
     '''
-    ver = getMatches(inp, "([0-9,\.]+)")
+    ver = getMatches(inp, version_re)
     if len(ver) == 0:
         ver = ['unknown']
         
@@ -136,181 +469,417 @@ def split_counter_row(inp):
     return routers, floodfills, leasesets, clienttunnels, transittunnels
 
 
+def process_homepage(homepage):
+    ''' Extract stats from the webconsole's homepage
+    
+    Returns a dict
+    '''
+    stats = {
+        "network_status_v6" : "disabled"
+        }
+    
+    bold_fields = getMatches(homepage, bold_field_re)
+    
+    for line in bold_fields:
+        if line.startswith("Uptime:"):
+            stats["uptime"] = process_uptime(line)
+        if line.startswith("Network status:"):
+            stats["network_status"] = process_netstatus(line)
+        if line.startswith("Network status v6:"):
+            stats["network_status_v6"] = process_netstatus(line)
+        elif line.startswith("Tunnel creation success rate:"):
+            stats["creation_success"] = process_percentage(line)
+        elif line.startswith("Received:"):
+            stats["in_vol"], stats["in_through"] = extract_throughput(line)
+        elif line.startswith("Sent:"):
+            stats["out_vol"], stats["out_through"] = extract_throughput(line)
+        elif line.startswith("Transit:"):
+            stats["transit_vol"], stats["transit_through"] = extract_throughput(line)
+        elif line.startswith("Version:"):
+            stats["version"] = extract_version(line)
+        elif line.startswith("Routers:"):
+            stats["routers"], stats["floodfills"], stats["leasesets"], x, y = split_counter_row(line)
+        elif line.startswith("Client Tunnels:"):
+            x, y, z, stats["clienttunnels"], stats["transittunnels"] = split_counter_row(line)
+            
+    return stats
+
+
+def new_tunnel_counts():
+    ''' Return a zeroed set of counters for one tunnel direction
+    '''
+    return {
+        "tunnels" : 0,
+        "expiring" : 0,
+        "established" : 0,
+        "exploring" : 0,
+        "building" : 0,
+        "failed" : 0
+        }
+
+
+class LatencySketch:
+    ''' Fixed size quantile sketch (in the style of DDSketch)
+    
+    Values are counted into logarithmically sized buckets, so quantiles come
+    back with a bounded relative error. The number of buckets depends only
+    on accuracy and max_value, however many values are added
+    '''
+    
+    def __init__(self, accuracy=latency_accuracy, max_value=latency_max_ms):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = [0] * (math.ceil(math.log(max_value) / self.log_gamma) + 1)
+        
+        # Upper bound of each bucket, so values can be bucketed with a 
+        # binary search rather than taking a log of each one
+        self.bounds = [self.gamma ** i for i in range(len(self.buckets))]
+        self.count = 0
+        self.max = 0
+        
+    def add(self, value):
+        ''' Add a value to the sketch
+        '''
+        self.count += 1
+        if value > self.max:
+            self.max = value
+            
+        # Bucket i holds values in (gamma^(i-1), gamma^i]
+        idx = bisect_left(self.bounds, value)
+        if idx == len(self.buckets):
+            idx -= 1
+        self.buckets[idx] += 1
+        
+    def quantile(self, q):
+        ''' Estimate the value at quantile q (0-1)
+        '''
+        if not self.count:
+            return 0
+        
+        rank = q * (self.count - 1)
+        seen = 0
+        for idx, cnt in enumerate(self.buckets):
+            seen += cnt
+            if seen > rank:
+                break
+        
+        # The midpoint of the bucket in relative terms
+        estimate = 2 * (self.gamma ** idx) / (self.gamma + 1)
+        return round(min(estimate, self.max), 3)
+
+
+def new_tunnel_details():
+    ''' Return empty latency and hop count trackers for one tunnel direction
+    '''
+    return {
+        "latency" : LatencySketch(),
+        "hops" : [0] * (max_hops + 1)
+        }
+
+
+def count_tunnels(tunnels_page, start, end, details=False):
+    ''' Count the tunnels listed between offsets start and end by state
+    
+    Each tunnel is folded into the counters as it's matched, rather
+    than collecting the matches first
+    
+    If details is provided (see new_tunnel_details()) latency and hop 
+    counts are added to it from the same match, so there's still only
+    one pass over the page
+    '''
+    counts = new_tunnel_counts()
+    tunnels = 0
+    if details:
+        hop_counts = details["hops"]
+        add_latency = details["latency"].add
+        for match in tunnel_detail_re.finditer(tunnels_page, start, end):
+            hops, ms, state, exploratory = match.groups()
+            tunnels += 1
+            if state in tunnel_states:
+                counts[state] += 1
+                if exploratory and state == "established":
+                    counts['exploring'] += 1
+            hops = hops.count(hop_separator) - 1
+            hop_counts[hops if 0 <= hops <= max_hops else (0 if hops < 0 else max_hops)] += 1
+            if ms:
+                add_latency(int(ms))
+    else:
+        for match in tunnel_state_re.finditer(tunnels_page, start, end):
+            state, exploratory = match.groups()
+            tunnels += 1
+            if state in tunnel_states:
+                counts[state] += 1
+                if exploratory and state == "established":
+                    counts['exploring'] += 1
+
+    counts['tunnels'] = tunnels
+    return counts
 
 
-stats_status = "available"
+def process_tunnels_page(tunnels_page, details=False):
+    ''' Count tunnels by direction and state
 
-# We grab pages to begin with - we don't want too much delay between page reads
-# otherwise stats might diverge
-try:
-    homepage = getPage("/", HOST)
-    tunnels_page = getPage("/?page=tunnels", HOST)
-except:
-    stats_status = "unavailable"
+    Inbound tunnels are listed first, so everything before the outbound
+    heading is inbound. The page is tokenized in place in a single pass,
+    rather than being split into sections and then lines
     
-    tags = "url={url},statspage_status={stats_status}".format(
-                            url = HOST,    
-                            stats_status = stats_status
-                            )    
+    If details is provided, it should be a dict with keys inbound and 
+    outbound, each holding the output of new_tunnel_details()
+
+    Returns a tuple of dicts: inbound, outbound
+    '''
+    split = tunnels_page.find("<b>Outbound tunnels:</b>")
+    if split == -1:
+        split = len(tunnels_page)
+        
+    if not details:
+        details = {"inbound" : False, "outbound" : False}
+
+    return (count_tunnels(tunnels_page, 0, split, details["inbound"]), 
+            count_tunnels(tunnels_page, split, len(tunnels_page), details["outbound"]))
+
+
+def build_tunnel_lp(direction, counts):
+    ''' Build a line of line protocol for each tunnel state in a direction
+    '''
+    lines = []
+    for tun_state in counts:
+        if tun_state == "tunnels":
+            continue
+        
+        lp = "{measurement},url={url},tunnel_state={state},direction={direction} tunnel_count={cnt}i".format(
+                            measurement = MEASUREMENT,
+                            url = HOST,
+                            state = tun_state,
+                            direction = direction,
+                            cnt = counts[tun_state]
+                            )
+        lines.append(lp)
+        
+    return lines
+
+
+def build_tunnel_details_lp(direction, details):
+    ''' Build line protocol for the latency quantiles and hop count histogram of a direction
+    '''
+    sketch = details["latency"]
+    fields = ["latency_samples={}i".format(sketch.count)]
+    if sketch.count:
+        fields.append("latency_p50_ms={}".format(sketch.quantile(0.5)))
+        fields.append("latency_p90_ms={}".format(sketch.quantile(0.9)))
+        fields.append("latency_p99_ms={}".format(sketch.quantile(0.99)))
+        fields.append("latency_max_ms={}i".format(sketch.max))
+        
+    lines = ["{measurement},url={url},direction={direction} {fields}".format(
+                            measurement = MEASUREMENT,
+                            url = HOST,
+                            direction = direction,
+                            fields = ",".join(fields)
+                            )]
     
-    lp = "{measurement},{tags} failed=1".format(
+    for hops, cnt in enumerate(details["hops"]):
+        if not cnt:
+            continue
+        
+        lp = "{measurement},url={url},direction={direction},hops={hops} tunnels_by_hops={cnt}i".format(
                             measurement = MEASUREMENT,
-                            tags = tags
+                            url = HOST,
+                            direction = direction,
+                            hops = hops,
+                            cnt = cnt
                             )
-    print(lp)    
-    sys.exit()
-
-
-bold_fields = getMatches(homepage, "<b>(.+)<br>")
-#print(bold_fields)
-
-network_status_v6 = "disabled"
-
-for line in bold_fields:
-    if line.startswith("Uptime:"):
-        uptime = process_uptime(line)
-    if line.startswith("Network status:"):
-        network_status = process_netstatus(line)
-    if line.startswith("Network status v6:"):
-        network_status_v6 = process_netstatus(line)
-    elif line.startswith("Tunnel creation success rate:"):
-        creation_success = process_percentage(line)
-    elif line.startswith("Received:"):
-        in_vol, in_through = extract_throughput(line)
-    elif line.startswith("Sent:"):
-        out_vol, out_through = extract_throughput(line)
-    elif line.startswith("Transit:"):
-        transit_vol, transit_through = extract_throughput(line)
-    elif line.startswith("Version:"):
-        version = extract_version(line)
-    elif line.startswith("Routers:"):
-        routers, floodfills, leasesets, x, y = split_counter_row(line)
-    elif line.startswith("Client Tunnels:"):
-        x, y, z, clienttunnels, transittunnels = split_counter_row(line)
+        lines.append(lp)
         
+    return lines
 
-# This is narsty.... 
-page_split = tunnels_page.split("<b>Outbound tunnels:</b>")
-
-# Prepare the dicts
-inbound = {
-    "tunnels" : 0,
-    "expiring" : 0,
-    "established" : 0,
-    "exploring" : 0,
-    "building" : 0,
-    "failed" : 0
-    }
 
-outbound = {
-    "tunnels" : 0,
-    "expiring" : 0,
-    "established" : 0,
-    "exploring" : 0,
-    "building" : 0,
-    "failed" : 0    
-    }
+def new_transport_counts():
+    ''' Return a zeroed set of counters for one transport and IP family
+    '''
+    return {
+        "sessions" : 0,
+        "sessions_outbound" : 0,
+        "sessions_large" : 0,
+        "sent_bytes" : 0,
+        "received_bytes" : 0
+        }
 
 
-# Status strings can be seen here https://github.com/PurpleI2P/i2pd/blob/openssl/daemon/HTTPServer.cpp#L134
-for line in page_split[0].split("\n"):
-    if line.startswith('<div class="listitem">'):
-        inbound['tunnels'] += 1            
-        if "tunnel expiring" in line:
-            inbound['expiring'] += 1
-        elif "tunnel building" in line:
-            inbound['building'] += 1
-        elif "tunnel failed" in line:
-            inbound['failed'] += 1
-        elif "tunnel established" in line:
-            inbound['established'] += 1
-            if "(exploratory)" in line:
-                inbound['exploring'] += 1
-
-
-for line in page_split[1].split("\n"):
-    if line.startswith('<div class="listitem">'):
-        outbound['tunnels'] += 1
-        if "tunnel expiring" in line:
-            outbound['expiring'] += 1
-        elif "tunnel building" in line:
-            outbound['building'] += 1
-        elif "tunnel failed" in line:
-            outbound['failed'] += 1
-        elif "tunnel established" in line:
-            outbound['established'] += 1
-            if "(exploratory)" in line:
-                outbound['exploring'] += 1
-
-
-
-lp_buffer = []
-
-fields = "uptime={uptime}i,tunnel_creation_success_rate={success_rate},in_bytes={in_bytes}i,in_avg_bps={in_bps}".format(
-                        uptime = uptime,
-                        success_rate = creation_success,
-                        in_bytes = in_vol,
-                        in_bps = in_through,
-                        )
-
-
-fields = "{fields},out_bytes={out_bytes}i,out_avg_bps={out_bps},transit_bytes={transit_bytes}i,transit_avg_bps={transit_bps}".format(
-                        fields = fields,
-                        success_rate = creation_success,
-                        out_bytes = out_vol,
-                        out_bps = out_through,
-                        transit_bytes = transit_vol,
-                        transit_bps = transit_through
-                        )
-
-fields = "{fields},routers={routers}i,floodfills={floodfills}i,leasesets={leasesets}i,clienttunnels={clienttunnels}i,transittunnels={transittunnels}i".format(
-                        fields = fields,
-                        routers = routers,
-                        floodfills = floodfills,
-                        leasesets = leasesets,
-                        clienttunnels = clienttunnels,
-                        transittunnels = transittunnels
-                        )
-
-for tun_state in inbound:
-    if tun_state == "tunnels":
-        continue
-    
-    lp = "{measurement},url={url},tunnel_state={state},direction=inbound tunnel_count={cnt}i".format(
-                        measurement = MEASUREMENT,
-                        url = HOST,
-                        state = tun_state,
-                        cnt = inbound[tun_state]
-                        )
-    lp_buffer.append(lp)
-
-for tun_state in outbound:
-    if tun_state == "tunnels":
-        continue
-    
-    lp = "{measurement},url={url},tunnel_state={state},direction=outbound tunnel_count={cnt}i".format(
-                        measurement = MEASUREMENT,
-                        url = HOST,
-                        state = tun_state,
-                        cnt = outbound[tun_state]
-                        )
-    lp_buffer.append(lp)
-
-
-tags = "url={url},version={version},network_status={network_status},network_status_v6={network_status_v6},statspage_status={stats_status}".format(
-                        url = HOST,    
-                        version = version,
-                        network_status = network_status,
-                        network_status_v6 = network_status_v6,
-                        stats_status = stats_status
-                        )
-
-lp = "{measurement},{tags} {fields}".format(
-                        measurement = MEASUREMENT,
-                        tags = tags,
-                        fields = fields
-                        )
-
-lp_buffer.append(lp)
-
-print('\n'.join(lp_buffer))
+def process_transports_page(transports_page):
+    ''' Aggregate established transport sessions by transport and IP family
+    
+    Sessions are folded into the counters as the page is walked, so memory
+    use doesn't grow with the number of peers
+    
+    Returns a dict keyed by (transport, family)
+    '''
+    transports = {}
+    sections = list(transport_section_re.finditer(transports_page))
+    for i, section in enumerate(sections):
+        slide = section.group(1)
+        family = "ipv4"
+        if slide.endswith("v6"):
+            family = "ipv6"
+            slide = slide[:-2]
+            
+        counts = transports.setdefault((slide.upper(), family), new_transport_counts())
+        end = sections[i + 1].start() if i + 1 < len(sections) else len(transports_page)
+        
+        for match in transport_session_re.finditer(transports_page, section.end(), end):
+            outbound, sent, received = match.groups()
+            sent = int(sent)
+            received = int(received)
+            counts["sessions"] += 1
+            counts["sent_bytes"] += sent
+            counts["received_bytes"] += received
+            if outbound:
+                counts["sessions_outbound"] += 1
+            if sent + received > TRANSPORT_LARGE_BYTES:
+                counts["sessions_large"] += 1
+                
+    return transports
+
+
+def build_transport_lp(transports):
+    ''' Build a line of line protocol for each transport and IP family
+    '''
+    lines = []
+    for transport, family in sorted(transports):
+        counts = transports[(transport, family)]
+        lp = "{measurement},url={url},transport={transport},ip_family={family} {fields}".format(
+                            measurement = MEASUREMENT,
+                            url = HOST,
+                            transport = transport,
+                            family = family,
+                            fields = ",".join(["{}={}i".format(k, counts[k]) for k in counts])
+                            )
+        lines.append(lp)
+        
+    return lines
+
+
+def derive_rates(stats, state, now):
+    ''' Calculate bit rates over the interval since the previous run
+    
+    i2pd only reports averages since it started, which flatten out on a 
+    router that's been up for a while. Instead, the byte counters are 
+    persisted in state and we calculate from the deltas
+    
+    If uptime and the byte counters have gone backwards, i2pd has 
+    restarted and the counters will have been reset - the rate is then 
+    calculated over the uptime.
+    
+    Rates are added to stats, and the current counters are saved into state
+    '''
+    prev = state.get("counters", False)
+    if "uptime" not in stats:
+        # We can't detect restarts without uptime, so don't trust the deltas
+        state["counters"] = False
+        return
+    
+    if prev:
+        # Uptime alone isn't trusted, a misparse shouldn't lead to the
+        # whole counter being treated as a delta
+        restarted = stats["uptime"] < prev["uptime"] and any(
+            stats[counter] < prev[counter]
+            for counter in rate_counters if counter in stats and counter in prev
+            )
+        if restarted:
+            interval = stats["uptime"]
+        else:
+            interval = now - prev["ts"]
+            
+        for counter in rate_counters:
+            if counter not in stats or counter not in prev:
+                continue
+            
+            delta = stats[counter] if restarted else stats[counter] - prev[counter]
+            if interval > 0 and delta >= 0:
+                stats[rate_counters[counter]] = round((delta * 8) / interval, 3)
+                stats["rate_interval"] = round(interval, 3)
+                
+    state["counters"] = { k : stats[k] for k in rate_counters if k in stats }
+    state["counters"]["uptime"] = stats["uptime"]
+    state["counters"]["ts"] = now
+    
+
+def build_main_lp(stats, stats_status):
+    ''' Build the main line of line protocol from the stats dict
+    '''
+    fields = []
+    for f in main_fields:
+        if f[1] not in stats:
+            continue
+        if f[2] == "int":
+            fields.append("{}={}i".format(f[0], int(stats[f[1]])))
+        else:
+            fields.append("{}={}".format(f[0], stats[f[1]]))
+    
+    tags = "url={url},version={version},network_status={network_status},network_status_v6={network_status_v6},statspage_status={stats_status}".format(
+                            url = HOST,    
+                            version = stats.get("version", "unknown"),
+                            network_status = stats.get("network_status", "unknown"),
+                            network_status_v6 = stats.get("network_status_v6", "disabled"),
+                            stats_status = stats_status
+                            )
+
+    return "{measurement},{tags} {fields}".format(
+                            measurement = MEASUREMENT,
+                            tags = tags,
+                            fields = ",".join(fields)
+                            )
+
+
+def main():
+    stats_status = "available"
+    state = loadState()
+
+    # We grab pages to begin with - we don't want too much delay between page reads
+    # otherwise stats might diverge
+    try:
+        stats, homepage, tunnels_page, fetch_skew, transports_page = fetchPages(state)
+    except:
+        stats_status = "unavailable"
+
+        tags = "url={url},statspage_status={stats_status}".format(
+                                url = HOST,    
+                                stats_status = stats_status
+                                )    
+
+        lp = "{measurement},{tags} failed=1".format(
+                                measurement = MEASUREMENT,
+                                tags = tags
+                                )
+        print(lp)    
+        sys.exit()
+
+
+    if not stats:
+        stats = process_homepage(homepage)
+    stats["fetch_skew_ms"] = fetch_skew
+    derive_rates(stats, state, time.time())
+    saveState(state)
+
+    details = False
+    if TUNNEL_DETAILS:
+        details = {
+            "inbound" : new_tunnel_details(),
+            "outbound" : new_tunnel_details()
+            }
+    
+    inbound, outbound = process_tunnels_page(tunnels_page, details)
+
+    lp_buffer = build_tunnel_lp("inbound", inbound)
+    lp_buffer += build_tunnel_lp("outbound", outbound)
+    if details:
+        lp_buffer += build_tunnel_details_lp("inbound", details["inbound"])
+        lp_buffer += build_tunnel_details_lp("outbound", details["outbound"])
+    if transports_page:
+        lp_buffer += build_transport_lp(process_transports_page(transports_page))
+    lp_buffer.append(build_main_lp(stats, stats_status))
+
+    print('\n'.join(lp_buffer))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Microbenchmark for the pihole-granular-stats aggregator
+#
+# Generates synthetic getAllQueries rows and times queryLogToStats() against
+# the nested dict implementation it replaced
+#
+#   ./benchmark.py --rows 1000000 --clients 50 --minutes 15
+#
+# Top domains tracking and reply time histograms are also timed. Pass 
+# --decode to also time decoding the rows from a JSON response
+#
+# Copyright (c) 2023 B Tasker
+# Released under GNU GPL v3 - https://www.gnu.org/licenses/gpl-3.0.txt
+#
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import time
+
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pihole-granular-stats.py")
+
+# Roughly how often each FTL status shows up on a typical network
+status_weights = {
+    1 : 15,
+    2 : 45,
+    3 : 30,
+    4 : 2,
+    5 : 1,
+    9 : 1,
+    12 : 1,
+    14 : 2,
+    17 : 3
+    }
+
+
+def load_plugin():
+    ''' Import the plugin as a module
+    '''
+    spec = importlib.util.spec_from_file_location("pihole_granular_stats", PLUGIN)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def generate_rows(count, clients, minutes, seed):
+    ''' Generate count getAllQueries rows spread over the last few minutes
+    '''
+    rand = random.Random(seed)
+    start = (int(time.time()) // 60 * 60) - (minutes * 60)
+    client_names = ["192.168.1.{}".format(x + 1) for x in range(clients)]
+    statuses = list(status_weights)
+    weights = list(status_weights.values())
+    upstreams = ["1.1.1.1#53", "9.9.9.9#53", "192.168.1.254#53"]
+
+    rows = []
+    for i in range(count):
+        ts = start + (i * minutes * 60) // count
+        status = rand.choices(statuses, weights)[0]
+
+        # Only forwarded queries have an upstream, reply times are in tenths of a ms
+        upstream = "N/A#0"
+        reply_time = 1
+        if status in (2, 12, 14):
+            upstream = rand.choice(upstreams)
+            reply_time = int(rand.lognormvariate(5, 1.5))
+
+        rows.append([
+            str(ts),
+            "A",
+            "host{}.example.com".format(rand.randint(1, 5000)),
+            rand.choice(client_names),
+            str(status),
+            "0",
+            "4",
+            str(reply_time),
+            "N/A",
+            "-1",
+            upstream,
+            "",
+            ""
+            ])
+    return rows, start + minutes * 60
+
+
+def legacy_query_log_to_stats(queries, until):
+    ''' The nested dict aggregator that queryLogToStats() replaced
+
+    The shallow copy of the clients dict has been fixed so that the
+    results can be compared
+    '''
+    answer_types = {
+                "blocklisted" : 0,
+                "forwarded" : 0,
+                "cachedresponse" : 0,
+                "wildcardblock" : 0,
+                "total" : 0
+                }
+    results = {}
+    for row in queries:
+        ts = int(int(row[0])//60 * 60)
+        if ts >= until:
+            continue
+
+        client = row[3]
+        resp_type = int(row[4])
+        answer_type = False
+        if resp_type in [1, 5, 6, 7, 8, 9, 11, 16]:
+            answer_type = "blocklisted"
+        elif resp_type in [2, 12, 13, 14]:
+            answer_type = "forwarded"
+        elif resp_type in [3, 17]:
+            answer_type = "cachedresponse"
+        elif resp_type in [4, 10]:
+            answer_type = "wildcardblock"
+
+        if ts not in results:
+            results[ts] = {"clients" : {}}
+        if client not in results[ts]["clients"]:
+            results[ts]["clients"][client] = answer_types.copy()
+
+        if answer_type:
+            results[ts]["clients"][client][answer_type] += 1
+        results[ts]["clients"][client]["total"] += 1
+
+    return results
+
+
+def flatten_legacy(results):
+    ''' Convert legacy results into a comparable form
+    '''
+    return {
+        (ts, client) : list(results[ts]["clients"][client].values())
+        for ts in results for client in results[ts]["clients"]
+        }
+
+
+def flatten(results):
+    ''' Convert queryLogToStats() results into a comparable form
+    '''
+    return {
+        (ts, results["clients"][cid]) : counters
+        for (ts, cid), counters in results["buckets"].items()
+        }
+
+
+def timed(name, func, *args):
+    ''' Run func, printing how long it took
+    '''
+    start = time.perf_counter()
+    res = func(*args)
+    print("{:<24} {:>9.3f}ms".format(name, (time.perf_counter() - start) * 1000))
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pihole-granular-stats aggregator")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--minutes", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--decode", action="store_true", help="Also time decoding rows from a JSON response")
+    parser.add_argument("--domain-capacity", type=int, default=50, help="Sketch size used when timing top domains tracking")
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    rows, until = generate_rows(args.rows, args.clients, args.minutes, args.seed)
+    print("{} rows, {} clients, {} minutes".format(args.rows, args.clients, args.minutes))
+
+    new = timed("queryLogToStats", plugin.queryLogToStats, rows, until)
+    old = timed("legacy", legacy_query_log_to_stats, rows, until)
+    timed("statsToLP", plugin.statsToLP, plugin.MEASUREMENT, new)
+
+    with_domains = timed("with top domains", plugin.queryLogToStats, rows, until, args.domain_capacity)
+    timed("domainsToLP", plugin.domainsToLP, plugin.DOMAINS_MEASUREMENT, with_domains, 5)
+
+    with_replies = timed("with reply times", plugin.queryLogToStats, rows, until, 0, True)
+    timed("replyTimesToLP", plugin.replyTimesToLP, plugin.REPLY_TIMES_MEASUREMENT, with_replies)
+
+    if args.decode:
+        raw = json.dumps({"data" : rows}).encode()
+        chunks = [raw[i:i + plugin.CHUNK_SIZE] for i in range(0, len(raw), plugin.CHUNK_SIZE)]
+        timed("decode + aggregate", plugin.queryLogToStats, plugin.iterQueryRows(chunks), until)
+
+    if flatten(new) != flatten_legacy(old):
+        print("Results differ from the legacy implementation")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
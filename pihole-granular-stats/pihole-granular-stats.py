@@ -7,9 +7,19 @@
 # Released under GNU GPL v3 - https://www.gnu.org/licenses/gpl-3.0.txt
 #
 
+import codecs
+import json
+import os
+import re
 import requests
+import sqlite3
 import sys
-from datetime import datetime, timedelta
+import tempfile
+import time
+import urllib.request
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 # Pihole connection info
 PIHOLE_ADDRESS="http://127.0.0.1:8080"
@@ -17,29 +27,361 @@ PIHOLE_ADDRESS="http://127.0.0.1:8080"
 # Auth token - get this from settings
 PIHOLE_TOKEN=""
 
-# How many minutes of logs to query on each
-# iteration
+# Pi-hole v6 password (or app password) - v6 backend only
+PIHOLE_PASSWORD=""
+
+# Where to get query logs from: api (Pi-hole v5's api.php),
+# v6 (Pi-hole v6's REST API) or sqlite (read FTL's database 
+# directly)
+BACKEND="api"
+
+# Where to cache the v6 API session between runs. This needs
+# to be in a directory which only we can write to (the default
+# is created if it doesn't exist)
+SESSION_FILE=os.path.join(tempfile.gettempdir(), f"pihole-granular-stats-{os.getuid()}", "session")
+
+# How many queries to fetch per request from the v6 API
+PAGE_SIZE=1000
+
+# To collect from several Pi-holes at once (for example an HA
+# pair), list them here. Each needs a name, and can set address,
+# token, password, backend, ftl_db and session_file - anything
+# not set comes from the settings above. For example
+#
+# INSTANCES=[
+#    {"name" : "pihole1", "address" : "http://192.168.1.2:8080", "token" : "abc"},
+#    {"name" : "pihole2", "address" : "http://192.168.1.3:8080", "token" : "def"}
+#    ]
+INSTANCES=[]
+
+# Whether to tag stats with the instance they came from (True)
+# or write totals across all instances (False)
+INSTANCE_TAG=False
+
+# Path to FTL's database (sqlite backend only)
+FTL_DB="/etc/pihole/pihole-FTL.db"
+
+# FTL only writes queries to its database periodically
+# (DBINTERVAL, 1 minute by default) so with the sqlite
+# backend we hold back this many minutes to let it catch up
+FTL_DB_LAG=2
+
+# How many minutes of logs to query on the first
+# run (later runs pick up from where the last one finished)
 QUERY_TIME_RANGE=15
 
+# After downtime, the maximum number of minutes
+# to go back and catch up on
+MAX_CATCHUP=60
+
+# Where to persist the watermark (and any rollup
+# buckets which haven't closed yet) between runs
+STATE_FILE=os.path.join(tempfile.gettempdir(), "pihole-granular-stats.state")
+
 # The measurement name to use
 MEASUREMENT="pihole_clients"
 
+# Bucket widths (in seconds, multiples of 60) to aggregate
+# into, and the measurement to write each into. For example
+# to also write 5 minute and 1 hour rollups
+#
+# RESOLUTIONS={
+#    60 : MEASUREMENT,
+#    300 : "pihole_clients_5m",
+#    3600 : "pihole_clients_1h"
+#    }
+RESOLUTIONS={
+    60 : MEASUREMENT
+    }
 
+# How many of each client's most queried blocked and
+# allowed domains to report per minute (0 disables)
+TOP_DOMAINS=0
 
-def getQueryLogs(pihole_addr, token, time_range):
-    ''' Build a request to the Pihole API to get query logs for the 
-    specified time range
+# How many domains to track per client per minute when
+# finding the top domains. Higher is more accurate but
+# uses more memory
+TOP_DOMAINS_CAPACITY=50
+
+# The measurement name to use for top domains
+DOMAINS_MEASUREMENT="pihole_client_domains"
+
+# Whether to build per-minute histograms of how long
+# upstreams took to reply, by client and by upstream
+REPLY_TIMES=False
+
+# Upper bounds (in milliseconds) of the reply time histogram
+# buckets. Anything slower lands in an overflow bucket
+REPLY_BUCKETS=[0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# The measurement name to use for reply times
+REPLY_TIMES_MEASUREMENT="pihole_reply_times"
+
+# How much of the API response to read at a time (bytes)
+CHUNK_SIZE=65536
+
+# Matches the start of the data array in a getAllQueries response
+DATA_START = re.compile(r'"data"\s*:\s*\[')
+
+# The counters in each stats block, in order
+answer_types = ["blocklisted", "forwarded", "cachedresponse", "wildcardblock", "total"]
+TOTAL = answer_types.index("total")
+FORWARDED = answer_types.index("forwarded")
+
+# Translate FTL query statuses into answer types
+# https://docs.pi-hole.net/database/ftl/#supported-status-types
+#
+# Statuses mapped to False (or not listed) are only counted in total
+status_types = {
+    0 : False,              # Unknown (no reply yet)
+    1 : "blocklisted",      # Blocked by gravity
+    2 : "forwarded",        # Forwarded upstream
+    3 : "cachedresponse",   # Answered from cache
+    4 : "wildcardblock",    # Blocked by a regex denylist entry
+    5 : "blocklisted",      # Blocked by an exact denylist entry
+    6 : "blocklisted",      # Blocked upstream (known blocking page IP)
+    7 : "blocklisted",      # Blocked upstream (NULL address)
+    8 : "blocklisted",      # Blocked upstream (NXDOMAIN with RA bit unset)
+    9 : "blocklisted",      # Blocked by gravity during CNAME inspection
+    10 : "wildcardblock",   # Blocked by a regex denylist entry during CNAME inspection
+    11 : "blocklisted",     # Blocked by an exact denylist entry during CNAME inspection
+    12 : "forwarded",       # Retried
+    13 : "forwarded",       # Retried but ignored (DNSSEC)
+    14 : "forwarded",       # Already forwarded, not forwarding again
+    15 : False,             # Database busy
+    16 : "blocklisted",     # Special domain
+    17 : "cachedresponse",  # Answered from stale cache
+    18 : "blocklisted"      # Blocked upstream (EDE 15)
+    }
+
+# The v6 API gives statuses and reply types by name, these are 
+# in the order of FTL's numeric codes
+# https://github.com/pi-hole/FTL/blob/master/src/enums.h
+v6_statuses = [
+    "UNKNOWN", "GRAVITY", "FORWARDED", "CACHE", "REGEX", "DENYLIST",
+    "EXTERNAL_BLOCKED_IP", "EXTERNAL_BLOCKED_NULL", "EXTERNAL_BLOCKED_NXRA",
+    "GRAVITY_CNAME", "REGEX_CNAME", "DENYLIST_CNAME", "RETRIED", "RETRIED_DNSSEC",
+    "IN_PROGRESS", "DBBUSY", "SPECIAL_DOMAIN", "CACHE_STALE", "EXTERNAL_BLOCKED_EDE15"
+    ]
+v6_status_codes = {name : code for code, name in enumerate(v6_statuses)}
+
+v6_reply_types = [
+    "UNKNOWN", "NODATA", "NXDOMAIN", "CNAME", "IP", "DOMAIN", "RRNAME",
+    "SERVFAIL", "REFUSED", "NOTIMP", "OTHER", "DNSSEC", "NONE", "BLOB"
+    ]
+v6_reply_codes = {name : code for code, name in enumerate(v6_reply_types)}
+
+# Lookup table of status to counter index (None for total only),
+# so that the hot loop doesn't have to translate strings
+status_index = [
+    answer_types.index(status_types[x]) if status_types.get(x, False) else None
+    for x in range(max(status_types) + 1)
+    ]
+
+# Which list (if any) a status's domains are counted in for top domains
+list_types = {
+    "blocklisted" : "blocked",
+    "wildcardblock" : "blocked",
+    "forwarded" : "allowed",
+    "cachedresponse" : "allowed"
+    }
+status_list = [
+    list_types[answer_types[x]] if x is not None else None
+    for x in status_index
+    ]
+
+# Aggregates the FTL database's queries by minute, client and status
+FTL_QUERY = '''
+    SELECT (timestamp / 60) * 60 AS minute, client, status, COUNT(*)
+    FROM queries
+    WHERE timestamp >= ? AND timestamp < ?
+    GROUP BY minute, client, status
+'''
+
+# As above, but also by domain
+FTL_DOMAIN_QUERY = '''
+    SELECT (timestamp / 60) * 60 AS minute, client, status, domain, COUNT(*)
+    FROM queries
+    WHERE timestamp >= ? AND timestamp < ?
+    GROUP BY minute, client, status, domain
+'''
+
+# Aggregates the reply times of forwarded queries by minute, client,
+# upstream and histogram bucket. The bucket is calculated in SQLite
+# from REPLY_BUCKETS (reply_time is in seconds)
+FTL_REPLY_QUERY = '''
+    SELECT (timestamp / 60) * 60 AS minute, client, forward,
+        CASE {buckets} ELSE {overflow} END AS bucket,
+        COUNT(*), SUM(reply_time) * 1000
+    FROM queries
+    WHERE timestamp >= ? AND timestamp < ?
+        AND status IN ({statuses})
+        AND forward IS NOT NULL AND reply_time IS NOT NULL AND reply_type != 0
+    GROUP BY minute, client, forward, bucket
+'''.format(
+    buckets = " ".join(f"WHEN reply_time <= {bound / 1000!r} THEN {i}" for i, bound in enumerate(REPLY_BUCKETS)),
+    overflow = len(REPLY_BUCKETS),
+    statuses = ", ".join(str(x) for x, idx in enumerate(status_index) if idx == FORWARDED)
+    )
+
+
+class SpaceSaving:
+    ''' Space-Saving heavy hitters sketch
+    
+    Tracks counts for at most capacity items. When a new item arrives
+    and the sketch is full, it replaces the item with the lowest count
+    and inherits that count (recorded as its error). Any item occurring
+    more than 1/capacity of the time is guaranteed to be tracked, and
+    counts are never underestimated
+    
+    Metwally, Agrawal & El Abbadi, "Efficient Computation of Frequent and
+    Top-k Elements in Data Streams" (2005)
+    '''
+    __slots__ = ("capacity", "counts", "errors", "floor", "floor_items")
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        
+        # The lowest count, and items which (may) still have it
+        self.floor = 0
+        self.floor_items = []
+        
+    def add(self, item, count=1):
+        ''' Count an occurrence of item
+        '''
+        counts = self.counts
+        if item in counts:
+            counts[item] += count
+        elif len(counts) < self.capacity:
+            counts[item] = count
+            self.errors[item] = 0
+        else:
+            victim = self.victim()
+            floor = counts.pop(victim)
+            del self.errors[victim]
+            counts[item] = floor + count
+            self.errors[item] = floor
+            
+    def victim(self):
+        ''' Find an item with the lowest count
+        
+        Counts only ever go up, so the items found at the lowest count
+        are remembered and used until they've all been replaced or 
+        incremented, rather than scanning for every eviction
+        '''
+        counts = self.counts
+        while self.floor_items:
+            item = self.floor_items.pop()
+            if counts.get(item) == self.floor:
+                return item
+            
+        self.floor = min(counts.values())
+        self.floor_items = [k for k, v in counts.items() if v == self.floor]
+        return self.floor_items.pop()
+
+    def merge(self, other):
+        ''' Merge another sketch into this one
+        
+        An item that a full sketch isn't tracking could have occurred
+        as many times as its lowest count, so that's added to the 
+        item's count and error. This keeps counts overestimates, with 
+        error still bounding how far out they are. The capacity items
+        with the highest counts are then kept
+        
+        Agarwal et al, "Mergeable Summaries" (2012)
+        '''
+        floors = [
+            min(sketch.counts.values()) if len(sketch.counts) >= sketch.capacity else 0
+            for sketch in (self, other)
+            ]
+        counts = {}
+        errors = {}
+        for item in self.counts.keys() | other.counts.keys():
+            counts[item] = 0
+            errors[item] = 0
+            for sketch, floor in zip((self, other), floors):
+                counts[item] += sketch.counts.get(item, floor)
+                errors[item] += sketch.errors.get(item, floor)
+        
+        keep = sorted(counts, key=lambda x: (-counts[x], x))[:self.capacity]
+        self.counts = {item : counts[item] for item in keep}
+        self.errors = {item : errors[item] for item in keep}
+        
+        # Force the floor to be recalculated
+        self.floor = 0
+        self.floor_items = []
+        
+    def top(self, n):
+        ''' Return the n items with the highest counts as (item, count, error) tuples
+        '''
+        items = sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))[:n]
+        return [(item, count, self.errors[item]) for item, count in items]
+
+
+
+def loadState(state_file):
+    ''' Load the state persisted by the previous run
+    
+    This contains
+    
+    * watermark: the start of the first minute which hasn't
+      yet been processed
+    * open: rollup buckets which haven't closed yet, keyed by
+      bucket width
     '''
-    # Calculate the time bounds
-    now = datetime.now()
-    end_s = now.strftime('%s')
+    try:
+        with open(state_file, "r") as f:
+            state = json.load(f)
+        state["watermark"] = int(state["watermark"])
+        state.setdefault("open", {})
+        return state
+    except (OSError, ValueError, KeyError, TypeError):
+        return {
+            "watermark" : False,
+            "open" : {}
+            }
     
-    # Calculate the startt time and round it to the 
-    # nearest full minute
-    start = now - timedelta(minutes = time_range)
-    start_str = start.strftime('%s')
-    start_s = int(int(start_str)//60 * 60)
+    
+def saveState(state_file, state):
+    ''' Persist state for the next run
+    
+    This goes via a temporary file that mkstemp() creates, rather than
+    a predictable name that someone else could have created first
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_file)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, state_file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    
+    
+def getQueryWindow(watermark, time_range, max_catchup, now):
+    ''' Calculate the time bounds to query
+    
+    The window ends at the start of the current minute, so that we 
+    only report on minutes which have closed. It starts at the watermark
+    (or time_range minutes ago if there isn't one) but is never allowed
+    to go back more than max_catchup minutes
+    '''
+    end_s = int(now//60 * 60)
+    
+    start_s = watermark
+    if not start_s:
+        start_s = end_s - (time_range * 60)
+        
+    start_s = max(start_s, end_s - (max_catchup * 60))
+    return start_s, end_s
+
 
+def getQueryLogs(pihole_addr, token, start_s, end_s):
+    ''' Build a request to the Pihole API to get query logs for the 
+    specified time range
+    '''
     # Build the request
     args = {
         "from" : start_s,
@@ -48,78 +390,581 @@ def getQueryLogs(pihole_addr, token, time_range):
         }
     url = f"{pihole_addr}/admin/api.php?getAllQueries"
     
-    # Place and return
-    r = requests.get(url=url, params=args)
-    return r.json()
+    # Place the request and stream the rows back out of the response
+    with requests.get(url=url, params=args, stream=True) as r:
+        yield from iterQueryRows(r.iter_content(chunk_size=CHUNK_SIZE))
+
+
+def privateDir(path):
+    ''' Create a directory that only we can write to, or check that an 
+    existing one is
+    
+    Raises OSError if it belongs to someone else or others can write to it
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise OSError(f"{path} can be written to by other users")
+
+
+def loadSession(session_file):
+    ''' Load the cached v6 API session, if there's one which hasn't expired
+    '''
+    try:
+        privateDir(os.path.dirname(os.path.abspath(session_file)))
+        with open(session_file, "r") as f:
+            session = json.load(f)
+        if session["expires"] > time.time():
+            return session
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return False
+
+
+def saveSession(session_file, session):
+    ''' Cache the v6 API session for the next run
+    
+    The session ID is as good as a password until it expires, so it's
+    kept in a private directory and written via a temporary file that
+    mkstemp() creates (readable only by us, and never a file or link 
+    that already existed)
+    '''
+    directory = os.path.dirname(os.path.abspath(session_file))
+    privateDir(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(session, f)
+        os.replace(tmp, session_file)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def v6Authenticate(http, pihole_addr, password, session_file):
+    ''' Log into the v6 API and cache the session
+    
+    Raises ValueError if the login is rejected
+    '''
+    r = http.post(url=f"{pihole_addr}/api/auth", json={"password" : password})
+    if r.status_code != 200:
+        raise ValueError(f"Authentication failed: HTTP {r.status_code}")
+    
+    auth = r.json()["session"]
+    if not auth["valid"]:
+        raise ValueError("Authentication failed: " + str(auth.get("message")))
+        
+    # If Pi-hole doesn't have a password set, sid is null and
+    # requests don't need one
+    session = {
+        "sid" : auth["sid"],
+        "validity" : auth["validity"],
+        "expires" : time.time() + auth["validity"]
+        }
+    saveSession(session_file, session)
+    return session
+
+
+def getV6QueryLogs(pihole_addr, password, start_s, end_s, session_file, page_size):
+    ''' Fetch query logs for the specified time range from the Pi-hole 
+    v6 API, yielding them as rows in the same format as getAllQueries
+    
+    The session is reused between runs (Pi-hole only allows a limited
+    number at once), and is only renewed once it's expired or been 
+    rejected. 
+    
+    Results are fetched page_size at a time: the cursor returned with 
+    the first page pins the set of queries being paged through, so 
+    later pages aren't shifted by new queries arriving
+    
+    Raises ValueError if a request fails
+    '''
+    url = f"{pihole_addr}/api/queries"
+    with requests.Session() as http:
+        session = loadSession(session_file)
+        if not session:
+            session = v6Authenticate(http, pihole_addr, password, session_file)
+        
+        args = {
+            "from" : start_s,
+            "until" : end_s,
+            "length" : page_size,
+            "start" : 0
+            }
+        retried = False
+        while True:
+            headers = {"X-FTL-SID" : session["sid"]} if session["sid"] else {}
+            r = http.get(url=url, params=args, headers=headers)
+            if r.status_code == 401 and not retried:
+                # The session has expired (or been logged out), get a new one
+                session = v6Authenticate(http, pihole_addr, password, session_file)
+                retried = True
+                continue
+            if r.status_code != 200:
+                raise ValueError(f"Query request failed: HTTP {r.status_code}")
+            
+            page = r.json()
+            queries = page["queries"]
+            args["cursor"] = page["cursor"]
+            for query in queries:
+                yield v6QueryToRow(query)
+            
+            if len(queries) < page_size:
+                break
+            args["start"] += len(queries)
+            
+        # Each use extends the session
+        session["expires"] = time.time() + session["validity"]
+        saveSession(session_file, session)
+
+
+def v6QueryToRow(query):
+    ''' Convert a query from the v6 API into a getAllQueries style row
+    
+    Only the columns that queryLogToStats() uses are filled in. Clients
+    are identified by IP, as they are in FTL's database
+    '''
+    reply = query.get("reply") or {}
+    reply_time = reply.get("time")
+    return [
+        int(query["time"]),
+        query["type"],
+        query["domain"],
+        query["client"]["ip"],
+        v6_status_codes.get(query["status"], 0),
+        None,
+        v6_reply_codes.get(reply.get("type"), 0),
+        round(reply_time * 10000) if reply_time and reply_time > 0 else 0,
+        None,
+        None,
+        query.get("upstream") or "N/A"
+        ]
+
+
+def iterQueryRows(chunks):
+    ''' Incrementally decode the rows of the data array in a 
+    getAllQueries response
+    
+    Takes an iterable of byte chunks and yields one row at a time, so
+    only the row being decoded (plus a chunk) is held in memory
+    rather than the entire response
+    
+    Raises ValueError if the response doesn't contain a complete
+    data array (for example, if auth failed)
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    in_data = False
+    
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        
+        if not in_data:
+            m = DATA_START.search(buf)
+            if not m:
+                # Hang onto enough to catch the key being split across chunks
+                pos = max(len(buf) - 32, 0)
+                continue
+            pos = m.end()
+            in_data = True
+            
+        while True:
+            # Skip over separators
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+                
+            if pos == len(buf):
+                break
+                
+            if buf[pos] == "]":
+                # End of the data array
+                return
+            
+            try:
+                row, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The row is incomplete, wait for the next chunk
+                break
+            
+            yield row
+            pos = end
+            
+    raise ValueError("Response did not contain a complete data array")
+
+
+def getFTLStats(db_path, start_s, end_s, domain_capacity=0, reply_times=False):
+    ''' Aggregate queries in the specified time range straight out of
+    FTL's database and build a stats object
+    
+    The database is opened read-only, and the aggregation happens
+    in SQLite, so we only handle one row per minute, client and status
+    
+    If domain_capacity is set, domains are also tracked (see queryLogToStats())
+    which means handling one row per minute, client, status and domain
+    
+    If reply_times is set, reply time histograms are also built, from
+    one row per minute, client, upstream and histogram bucket
+    '''
+    uri = "file:{}?mode=ro".format(urllib.request.pathname2url(db_path))
+    conn = sqlite3.connect(uri, uri=True, timeout=10)
+    try:
+        results = newStats(domain_capacity)
+        if domain_capacity:
+            for minute, client, status, domain, count in conn.execute(FTL_DOMAIN_QUERY, (start_s, end_s)):
+                addToStats(results, int(minute), client, int(status), count, domain)
+        else:
+            for minute, client, status, count in conn.execute(FTL_QUERY, (start_s, end_s)):
+                addToStats(results, int(minute), client, int(status), count)
+                
+        if reply_times:
+            for minute, client, upstream, bucket, count, total_ms in conn.execute(FTL_REPLY_QUERY, (start_s, end_s)):
+                addReplyTimes(results, int(minute), client, upstream, bucket, count, total_ms)
+    finally:
+        conn.close()
+        
+    return results
 
 
-def queryLogToStats(queries):
-    ''' Iterate over the query log results and build a stats object
+def getInstances(instances):
+    ''' Build the settings for each Pi-hole instance to collect from,
+    filling in anything they don't set from the defaults
+    
+    If no instances are configured, there's a single unnamed instance
+    using the defaults
+    '''
+    defaults = {
+        "name" : None,
+        "address" : PIHOLE_ADDRESS,
+        "token" : PIHOLE_TOKEN,
+        "password" : PIHOLE_PASSWORD,
+        "backend" : BACKEND,
+        "ftl_db" : FTL_DB,
+        "session_file" : SESSION_FILE
+        }
+    if not instances:
+        return [defaults]
+    
+    # Each instance needs its own v6 session
+    return [
+        {**defaults, "session_file" : f"{SESSION_FILE}-{instance['name']}", **instance}
+        for instance in instances
+        ]
+
+
+def getInstanceStats(instance, start_s, end_s, domain_capacity=0, reply_times=False):
+    ''' Collect stats for the specified time range from a Pi-hole 
+    instance, using whichever backend it's configured with
+    
+    Raises ValueError, sqlite3.Error or requests.RequestException/OSError
+    if collection fails
+    '''
+    if instance["backend"] == "sqlite":
+        stats = getFTLStats(instance["ftl_db"], start_s, end_s, domain_capacity, reply_times)
+    else:
+        # Stream the queries straight into the stats
+        if instance["backend"] == "v6":
+            queries = getV6QueryLogs(instance["address"], instance["password"], start_s, end_s, 
+                                     instance["session_file"], PAGE_SIZE)
+        else:
+            queries = getQueryLogs(instance["address"], instance["token"], start_s, end_s)
+        stats = queryLogToStats(queries, end_s, domain_capacity, reply_times)
+        
+    stats["instance"] = instance["name"]
+    return stats
+
+
+def collectStats(instances, start_s, end_s, domain_capacity=0, reply_times=False):
+    ''' Collect stats from all instances concurrently
+    
+    Each instance is fetched and aggregated in its own thread, so the
+    time taken is that of the slowest instance rather than the sum. 
+    Returns a list of stats objects, one per instance
     
+    If any instance fails, the exception (see getInstanceStats) is 
+    raised once they've all finished
     '''
-    # Define the structures that we'll collect stats into
-    answer_types = {
-                "blocklisted" : 0,
-                "forwarded" : 0,
-                "cachedresponse" : 0,
-                "wildcardblock" : 0,
-                "total" : 0
-                }
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        futures = [
+            executor.submit(getInstanceStats, instance, start_s, end_s, domain_capacity, reply_times)
+            for instance in instances
+            ]
+        return [future.result() for future in futures]
 
-    counters = {
-            "clients" : {}
+
+def newStats(domain_capacity=0, instance=None):
+    ''' Create an empty stats object
+    
+    Client names are interned and given an integer id. Counters are 
+    held in a flat dict keyed by (minute, client id), each being a 
+    list of integers in the same order as answer_types
+    
+    If domain_capacity is set, domains holds a pair of SpaceSaving 
+    sketches (blocked and allowed) per (minute, client id)
+    
+    replies holds reply time histograms keyed by (minute, client id, upstream),
+    see newHistogram()
+    
+    instance is the name of the Pi-hole instance the stats came from,
+    if they should be tagged with it
+    '''
+    return {
+        "instance" : instance,
+        "clients" : [],
+        "client_ids" : {},
+        "buckets" : {},
+        "domain_capacity" : domain_capacity,
+        "domains" : {},
+        "replies" : {}
         }
 
-    results = {}
+
+def newHistogram():
+    ''' Create an empty reply time histogram
+    
+    This is a list of the bucket counts (an array of integers,
+    in the same order as REPLY_BUCKETS, plus the overflow bucket)
+    and the sum of the reply times in milliseconds
+    '''
+    return [array("L", [0]) * (len(REPLY_BUCKETS) + 1), 0.0]
+
+
+def addReplyTimes(results, ts, client, upstream, bucket, count, total_ms):
+    ''' Add count replies, taking total_ms between them, to a histogram bucket
+    '''
+    key = (ts, clientId(results, client), upstream)
+    hist = results["replies"].get(key)
+    if hist is None:
+        hist = results["replies"][key] = newHistogram()
+    hist[0][bucket] += count
+    hist[1] += total_ms
+
+
+def mergeHistogram(hist, other):
+    ''' Add the counts and reply times of another histogram into hist
+    '''
+    counts = hist[0]
+    for i, count in enumerate(other[0]):
+        counts[i] += count
+    hist[1] += other[1]
+
+
+def histogramQuantile(counts, q):
+    ''' Estimate the q quantile of a histogram's reply times
+    
+    The value is linearly interpolated within the bucket that it
+    falls in. If that's the overflow bucket, all we know is that
+    it's above the last bound, so that's what is returned
+    '''
+    rank = q * sum(counts)
+    seen = 0
+    lower = 0
+    for count, upper in zip(counts, REPLY_BUCKETS):
+        if count and seen + count >= rank:
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+        lower = upper
+    return lower
+
+
+def clientId(results, client):
+    ''' Get the id of a client, allocating one if it's new
+    '''
+    client_ids = results["client_ids"]
+    cid = client_ids.get(client)
+    if cid is None:
+        client = sys.intern(client)
+        cid = len(results["clients"])
+        results["clients"].append(client)
+        client_ids[client] = cid
+    return cid
+
+
+def addCounters(results, ts, client, counters):
+    ''' Add a block of counters to the stats object
+    '''
+    key = (ts, clientId(results, client))
+    existing = results["buckets"].get(key)
+    if existing is None:
+        results["buckets"][key] = list(counters)
+    else:
+        for i, count in enumerate(counters):
+            existing[i] += count
+
+
+def rollupStats(stats, width, open_buckets, until):
+    ''' Roll per-minute stats up into buckets width seconds wide
+    
+    open_buckets is a list of [timestamp, client, counters] for buckets
+    which were still open at the end of the previous run: they're 
+    merged in before deciding which buckets have closed
+    
+    Returns a tuple: a stats object containing the buckets which closed 
+    by until, and a list of buckets which are still open
+    '''
+    rolled = newStats()
+    for ts, client, counters in open_buckets:
+        addCounters(rolled, ts, client, counters)
+        
+    clients = stats["clients"]
+    for (ts, cid), counters in stats["buckets"].items():
+        addCounters(rolled, ts // width * width, clients[cid], counters)
+        
+    closed = newStats(instance=stats["instance"])
+    still_open = []
+    for (ts, cid), counters in rolled["buckets"].items():
+        if ts + width <= until:
+            addCounters(closed, ts, rolled["clients"][cid], counters)
+        else:
+            still_open.append([ts, rolled["clients"][cid], counters])
+            
+    return closed, still_open
+
+
+def mergeStats(results, stats):
+    ''' Merge the stats collected from one instance into results
+    
+    Counters and reply time histograms add up exactly. Top domains
+    sketches are merged (see SpaceSaving.merge())
+    '''
+    clients = stats["clients"]
+    for (ts, cid), counters in stats["buckets"].items():
+        addCounters(results, ts, clients[cid], counters)
+        
+    for (ts, cid), sketches in stats["domains"].items():
+        key = (ts, clientId(results, clients[cid]))
+        existing = results["domains"].get(key)
+        if existing is None:
+            results["domains"][key] = sketches
+        else:
+            for list_type in existing:
+                existing[list_type].merge(sketches[list_type])
+                
+    for (ts, cid, upstream), hist in stats["replies"].items():
+        key = (ts, clientId(results, clients[cid]), upstream)
+        existing = results["replies"].get(key)
+        if existing is None:
+            results["replies"][key] = hist
+        else:
+            mergeHistogram(existing, hist)
+
+
+def addDomain(results, key, list_type, domain, count):
+    ''' Count queries for a domain in the relevant top domains sketch
+    '''
+    sketches = results["domains"].get(key)
+    if sketches is None:
+        sketches = results["domains"][key] = {
+            "blocked" : SpaceSaving(results["domain_capacity"]),
+            "allowed" : SpaceSaving(results["domain_capacity"])
+            }
+    sketches[list_type].add(domain, count)
+
+
+def addToStats(results, ts, client, resp_type, count, domain=False):
+    ''' Add count queries to the stats object
+    '''
+    key = (ts, clientId(results, client))
+    counters = results["buckets"].get(key)
+    if counters is None:
+        counters = results["buckets"][key] = [0] * len(answer_types)
+
+    # Increment the relevant counters
+    idx = status_index[resp_type] if 0 <= resp_type < len(status_index) else None
+    if idx is not None:
+        counters[idx] += count
+    counters[TOTAL] += count
+    
+    if domain and results["domain_capacity"] and idx is not None:
+        addDomain(results, key, status_list[resp_type], domain, count)
+
+
+def queryLogToStats(queries, until, domain_capacity=0, reply_times=False):
+    ''' Iterate over the query log rows and build a stats object
+    
+    Rows are folded into the stats as they arrive, so queries
+    can be a generator (see getQueryLogs())
+    
+    Queries at or after until are ignored: they're in a minute
+    which hasn't closed yet
+    
+    If domain_capacity is set, each client's blocked and allowed 
+    domains are tracked per minute in sketches of that size, so
+    memory use doesn't depend on the number of distinct domains
+    
+    If reply_times is set, forwarded queries which got a reply are 
+    added to reply time histograms. This needs the reply time (in 
+    tenths of a millisecond) and upstream columns, so rows from 
+    versions of Pi-hole which don't include them are skipped
+    '''
+    results = newStats(domain_capacity)
+    
+    # This runs once per query, so it's an inlined version 
+    # of addToStats() with everything held in locals
+    buckets = results["buckets"]
+    client_ids = results["client_ids"]
+    replies = results["replies"]
+    bounds = REPLY_BUCKETS
+    bucket_of = bisect_left
+    width = len(answer_types)
+    num_statuses = len(status_index)
 
     # Iterate over the result  set
-    for row in queries['data']:
+    for row in queries:
         # Round the timestamp to the nearest minute 
-        ts = int(int(row[0])//60 * 60)
+        ts = int(row[0])//60 * 60
+        if ts >= until:
+            continue
         
         # Client etc
-        client = row[3]
+        cid = client_ids.get(row[3])
+        if cid is None:
+            cid = clientId(results, row[3])
         resp_type = int(row[4])
         
-        # Translate the response type into a string
-        if resp_type == 1:
-            answer_type = "blocklisted"
-        elif resp_type == 2:
-            answer_type = "forwarded"    
-        elif resp_type == 3:
-            answer_type = "cachedresponse"    
-        elif resp_type == 4:
-            answer_type = "wildcardblock"    
+        key = (ts, cid)
+        counters = buckets.get(key)
+        if counters is None:
+            counters = buckets[key] = [0] * width
             
-        # Populate the stats objects if not already there
-        ts_key = ts
-        if ts_key not in results:
-            results[ts_key] = counters.copy()
-            
-        if client not in results[ts_key]["clients"]:
-            results[ts_key]["clients"][client] = answer_types.copy()
-
         # Increment the relevant counters
-        results[ts_key]["clients"][client][answer_type] += 1
-        results[ts_key]["clients"][client]["total"] += 1
+        idx = status_index[resp_type] if resp_type < num_statuses else None
+        if idx is not None:
+            counters[idx] += 1
+            if domain_capacity:
+                addDomain(results, key, status_list[resp_type], row[2], 1)
+            if reply_times and idx == FORWARDED and len(row) > 10 and int(row[6]) != 0:
+                upstream = row[10]
+                if upstream and not upstream.startswith("N/A"):
+                    ms = int(row[7]) / 10
+                    hist = replies.get((ts, cid, upstream))
+                    if hist is None:
+                        hist = replies[(ts, cid, upstream)] = newHistogram()
+                    hist[0][bucket_of(bounds, ms)] += 1
+                    hist[1] += ms
+        counters[TOTAL] += 1
 
     return results
 
 
-def statsBlockToLP(measurement, block, client, timestamp):
+def statsBlockToLP(measurement, block, client, timestamp, instance=None):
     ''' Convert an "answer_types" stats block to line protocol
     '''
     lps = [
         measurement,
         f"client={client}"
         ]
+    if instance:
+        lps.append(f"instance={instance}")
     
     lp1 = ','.join(lps)
     
     fields = []
     
-    for answer_type in block:
-        fields.append(f"{answer_type}={block[answer_type]}i")
+    for answer_type, count in zip(answer_types, block):
+        fields.append(f"{answer_type}={count}i")
 
     lp2 = ','.join(fields)
     lp = " ".join([lp1, lp2, str(timestamp * 1000000000)])
@@ -131,26 +976,123 @@ def statsToLP(measurement, stats):
     each client and timestamp pair
     '''
     lines = []
-    # Iterate over each timestamp grouping
-    for timestamp in stats:       
-        # Iterate over the clients
-        for client in stats[timestamp]["clients"]:
-            lp = statsBlockToLP(measurement, stats[timestamp]["clients"][client], client, timestamp)
-            lines.append(lp)            
+    clients = stats["clients"]
+    # Iterate over each timestamp and client pair
+    for timestamp, cid in sorted(stats["buckets"]):
+        lp = statsBlockToLP(measurement, stats["buckets"][(timestamp, cid)], clients[cid], timestamp, stats["instance"])
+        lines.append(lp)
         
     return lines
     
 
-if __name__ == "__main__":
-    # Get a list of queries
-    queries = getQueryLogs(PIHOLE_ADDRESS, PIHOLE_TOKEN, QUERY_TIME_RANGE)
+def domainsToLP(measurement, stats, top_n):
+    ''' Create line protocol for the top_n blocked and allowed domains 
+    of each client and timestamp pair
+    
+    Rank is used as a tag (rather than domain) to keep cardinality bounded
+    '''
+    lines = []
+    clients = stats["clients"]
+    instance = f",instance={stats['instance']}" if stats["instance"] else ""
+    for timestamp, cid in sorted(stats["domains"]):
+        sketches = stats["domains"][(timestamp, cid)]
+        for list_type in sketches:
+            for rank, (domain, count, error) in enumerate(sketches[list_type].top(top_n), 1):
+                domain = domain.replace("\\", "\\\\").replace('"', '\\"')
+                lines.append(f"{measurement},client={clients[cid]}{instance},list={list_type},rank={rank} "
+                             f"domain=\"{domain}\",count={count}i,error={error}i {timestamp * 1000000000}")
+                
+    return lines
 
-    if "data" not in queries:
-        # Request failed
-        sys.exit(1)
+
+def replyTimesToLP(measurement, stats):
+    ''' Create line protocol for the reply time histograms
+    
+    The histograms are combined into one per client and one per upstream
+    for each minute. Bucket counts are written cumulatively, with 
+    le_<bound> being the number of replies taking <bound> ms or less
+    '''
+    clients = stats["clients"]
+    combined = {}
+    for (timestamp, cid, upstream), hist in stats["replies"].items():
+        for tag in (f"client={clients[cid]}", f"upstream={upstream}"):
+            existing = combined.get((timestamp, tag))
+            if existing is None:
+                existing = combined[(timestamp, tag)] = newHistogram()
+            mergeHistogram(existing, hist)
+            
+    lines = []
+    for timestamp, tag in sorted(combined):
+        counts, total_ms = combined[(timestamp, tag)]
+        total = sum(counts)
+        fields = [
+            f"count={total}i",
+            f"mean_ms={total_ms / total:.3f}",
+            f"p95_ms={histogramQuantile(counts, 0.95):.3f}"
+            ]
+        cumulative = 0
+        for bound, count in zip(REPLY_BUCKETS + ["inf"], counts):
+            cumulative += count
+            fields.append(f"le_{bound}={cumulative}i")
+        tags = [tag]
+        if stats["instance"]:
+            tags.append(f"instance={stats['instance']}")
+        lines.append(f"{measurement},{','.join(sorted(tags))} {','.join(fields)} {timestamp * 1000000000}")
         
+    return lines
+    
 
-    stats = queryLogToStats(queries)
+if __name__ == "__main__":
+    instances = getInstances(INSTANCES)
+    
+    # Work out which minutes we need to fetch
+    now = time.time()
+    if any(instance["backend"] == "sqlite" for instance in instances):
+        now -= FTL_DB_LAG * 60
+    
+    state = loadState(STATE_FILE)
+    start_s, end_s = getQueryWindow(state["watermark"], QUERY_TIME_RANGE, MAX_CATCHUP, now)
+    if start_s >= end_s:
+        # No new minutes have closed since the last run
+        sys.exit(0)
+    
+    try:
+        instance_stats = collectStats(instances, start_s, end_s, TOP_DOMAINS and TOP_DOMAINS_CAPACITY, REPLY_TIMES)
+    except (ValueError, sqlite3.Error, requests.RequestException, OSError):
+        # A request failed or we couldn't read the database. Nothing
+        # is output, so that totals are never missing an instance
+        sys.exit(1)
+        
+    if not INSTANCE_TAG:
+        # Merge everything into one set of totals
+        stats = newStats(TOP_DOMAINS and TOP_DOMAINS_CAPACITY)
+        for collected in instance_stats:
+            mergeStats(stats, collected)
+        instance_stats = [stats]
 
-    lp_lines = statsToLP(MEASUREMENT, stats)
+    # Generate output at each resolution. All of the minutes 
+    # that we've collected have closed, but wider buckets may 
+    # still be open and need carrying over to the next run
+    lp_lines = []
+    open_buckets = {}
+    for stats in instance_stats:
+        for width in sorted(RESOLUTIONS):
+            if width == 60:
+                lp_lines += statsToLP(RESOLUTIONS[width], stats)
+                continue
+            
+            # Open buckets are kept per instance when tagging
+            key = f"{stats['instance']}/{width}" if stats["instance"] else str(width)
+            closed, open_buckets[key] = rollupStats(stats, width, state["open"].get(key, []), end_s)
+            lp_lines += statsToLP(RESOLUTIONS[width], closed)
+            
+        if TOP_DOMAINS:
+            lp_lines += domainsToLP(DOMAINS_MEASUREMENT, stats, TOP_DOMAINS)
+        if REPLY_TIMES:
+            lp_lines += replyTimesToLP(REPLY_TIMES_MEASUREMENT, stats)
     print('\n'.join(lp_lines))
+    
+    # Only move the watermark on once the stats have been output
+    state["watermark"] = end_s
+    state["open"] = open_buckets
+    saveState(STATE_FILE, state)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Benchmark tor-daemon.py against a fake control port
+#
+# Drives the collector against fake_control_port.py and reports wall time,
+# round trips and time spent in each phase of a collection
+#
+#   ./benchmark.py --iterations 20 --latency 0.005 --policy-rules 5000
+#
+# Copyright (c) 2022 B Tasker
+# Released under GNU GPL v3 - https://www.gnu.org/licenses/gpl-3.0.txt
+#
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import time
+
+import fake_control_port
+
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tor-daemon.py")
+
+# Functions in the plugin to time. Entries are (object name, attribute name)
+# where object name is None for module level functions
+phases = [
+    ("TorInstance", "connect"),
+    (None, "collect_stats"),
+    (None, "send_and_respond"),
+    (None, "get_circuit_counts"),
+    (None, "process_exit_policy"),
+    (None, "process_consensus"),
+    (None, "build_lp"),
+]
+
+
+def load_plugin(port, args):
+    ''' Import the plugin as a module, configured to talk to our fake control port
+    '''
+    os.environ["CONTROL_HOST"] = "127.0.0.1"
+    os.environ["CONTROL_PORT"] = str(port)
+    os.environ["CONTROL_AUTH"] = args.password
+    os.environ["CACHE_TTL"] = str(args.cache_ttl)
+    os.environ["CACHE_DIR"] = args.cache_dir
+    os.environ["CIRCUIT_STATS"] = "true" if args.circuit_stats else "false"
+    os.environ["CONSENSUS_STATS"] = "true" if args.consensus else "false"
+    
+    spec = importlib.util.spec_from_file_location("tor_daemon", PLUGIN)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def instrument(mod, timings):
+    ''' Wrap the functions listed in phases so that calls to them are timed
+    '''
+    for obj_name, attr in phases:
+        obj = getattr(mod, obj_name) if obj_name else mod
+        if not hasattr(obj, attr):
+            continue
+        
+        name = obj_name + "." + attr if obj_name else attr
+        timings[name] = []
+        
+        def wrap(fn, name):
+            def timed(*a, **kw):
+                start = time.perf_counter()
+                try:
+                    return fn(*a, **kw)
+                finally:
+                    timings[name].append(time.perf_counter() - start)
+            return timed
+        
+        setattr(obj, attr, wrap(getattr(obj, attr), name))
+        
+        
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tor-daemon.py against a fake control port")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--reconnect", action="store_true", help="reconnect for each collection (as in exec mode)")
+    parser.add_argument("--circuit-stats", action="store_true", help="enable CIRCUIT_STATS")
+    parser.add_argument("--consensus", action="store_true", help="enable CONSENSUS_STATS")
+    parser.add_argument("--cache-ttl", type=int, default=0, help="CACHE_TTL to use (default: caching disabled)")
+    parser.add_argument("--cache-dir", default="/tmp")
+    fake_control_port.add_args(parser)
+    args = parser.parse_args()
+    
+    info = fake_control_port.build_info(args.policy_rules, args.circuits, args.relays)
+    server = fake_control_port.FakeControlPort(("127.0.0.1", 0), info, args.password, args.latency)
+    server.start()
+    
+    mod = load_plugin(server.server_address[1], args)
+    timings = {}
+    instrument(mod, timings)
+    
+    tor = mod.TorInstance("127.0.0.1", server.server_address[1], args.password)
+    if args.cache_ttl == 0:
+        tor.cache.path = False
+    
+    walls = []
+    round_trips = []
+    for i in range(args.iterations):
+        if args.reconnect:
+            tor.close()
+        before = server.commands
+        start = time.perf_counter()
+        lp = tor.poll()
+        walls.append(time.perf_counter() - start)
+        round_trips.append(server.commands - before)
+        if "controlport_connection=success" not in lp:
+            print("Collection failed: " + lp)
+            sys.exit(1)
+    tor.close()
+    server.shutdown()
+        
+    print("iterations: %d  latency: %.1fms  policy rules: %d  circuits: %d  relays: %d" % (
+        args.iterations, args.latency * 1000, args.policy_rules, args.circuits, args.relays))
+    print("wall time per collection: mean %.2fms  min %.2fms  max %.2fms" % (
+        statistics.mean(walls) * 1000, min(walls) * 1000, max(walls) * 1000))
+    print("round trips per collection: mean %.1f  max %d" % (statistics.mean(round_trips), max(round_trips)))
+    print("line protocol size: %d bytes" % (len(lp),))
+    print("")
+    print("%-28s %8s %14s %14s" % ("phase", "calls", "ms/collection", "ms/call"))
+    for name in timings:
+        t = timings[name]
+        if len(t) == 0:
+            continue
+        print("%-28s %8d %14.2f %14.3f" % (name, len(t), sum(t) * 1000 / args.iterations, statistics.mean(t) * 1000))
+        
+        
+if __name__ == "__main__":
+    main()
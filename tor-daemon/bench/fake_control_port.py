@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# A fake tor control port, for benchmarking tor-daemon.py without a real relay
+#
+# Serves canned GETINFO replies, with optional per-reply latency and
+# synthetic exit policies, circuit tables and consensuses of configurable size
+#
+# Copyright (c) 2022 B Tasker
+# Released under GNU GPL v3 - https://www.gnu.org/licenses/gpl-3.0.txt
+#
+
+import argparse
+import base64
+import random
+import socketserver
+import threading
+import time
+
+
+def build_info(policy_rules=500, circuits=1000, relays=7000, seed=1):
+    ''' Build a dict of GETINFO key -> value
+    
+    Multi-line values are lists of lines
+    '''
+    rnd = random.Random(seed)
+    
+    info = {
+        "traffic/read" : "239214179",
+        "traffic/written" : "280990655",
+        "uptime" : "35874",
+        "version" : "0.4.8.9",
+        "dormant" : "0",
+        "status/reachability-succeeded/or" : "1",
+        "status/reachability-succeeded/dir" : "1",
+        "status/version/current" : "recommended",
+        "network-liveness" : "up",
+        "accounting/enabled" : "1",
+        "accounting/hibernating" : "awake",
+        "accounting/bytes" : "1048576 2097152",
+        "accounting/bytes-left" : "3145728 4194304",
+        "current-time/utc" : time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+        "accounting/interval-start" : time.strftime("%Y-%m-%d 00:00:00", time.gmtime()),
+        "accounting/interval-end" : time.strftime("%Y-%m-%d 23:59:59", time.gmtime()),
+        "fingerprint" : "%040X" % 1,
+        "consensus/valid-after" : time.strftime("%Y-%m-%d %H:00:00", time.gmtime()),
+    }
+    
+    info["entry-guards"] = [ "$%040X~guard%d %s" % (i, i, rnd.choice(["up", "down", "never-connected"])) for i in range(20) ]
+    
+    # A big reduced-exit style policy
+    policy = []
+    for i in range(policy_rules):
+        mode = rnd.choice(["accept", "reject"])
+        host = rnd.choice(["*", "%d.%d.%d.0/24" % (rnd.randint(1, 223), rnd.randint(0, 255), rnd.randint(0, 255))])
+        start = rnd.randint(1, 65000)
+        port = rnd.choice([str(start), "%d-%d" % (start, min(65535, start + rnd.randint(1, 5000))), "*"])
+        policy.append("%s %s:%s" % (mode, host, port))
+    policy.append("accept *:1-65535")
+    policy.append("reject *:*")
+    info["exit-policy/ipv4"] = policy
+    info["exit-policy/ipv6"] = "reject *:*"
+    
+    states = ["BUILT", "BUILT", "BUILT", "EXTENDED", "LAUNCHED", "GUARD_WAIT"]
+    purposes = ["GENERAL", "GENERAL", "HS_CLIENT_REND", "HS_SERVICE_INTRO", "CONFLUX_LINKED"]
+    info["circuit-status"] = [
+        "%d %s %s BUILD_FLAGS=NEED_CAPACITY PURPOSE=%s TIME_CREATED=2022-05-04T12:00:00.000000" % (
+            i, rnd.choice(states), ",".join("$%040X~r%d" % (h, h) for h in range(rnd.randint(1, 4))), rnd.choice(purposes))
+        for i in range(circuits)
+        ]
+    info["stream-status"] = [ "%d SUCCEEDED %d example%d.com:443" % (i, i, i) for i in range(circuits // 4) ]
+    info["orconn-status"] = [ "$%040X~r%d %s" % (i, i, rnd.choice(["CONNECTED", "LAUNCHED"])) for i in range(circuits // 10) ]
+    
+    ns = []
+    for i in range(relays):
+        ident = base64.b64encode(bytes.fromhex("%040X" % (i + 1))).decode().rstrip("=")
+        ns.append("r relay%d %s AAAAAAAAAAAAAAAAAAAAAAAAAAA 2022-05-04 11:00:00 10.%d.%d.%d 9001 0" % (
+            i, ident, (i >> 16) & 255, (i >> 8) & 255, i & 255))
+        ns.append("s " + " ".join(rnd.sample(["Exit", "Fast", "Guard", "HSDir", "Stable", "V2Dir"], 3) + ["Running", "Valid"]))
+        ns.append("w Bandwidth=%d" % rnd.randint(1, 100000))
+    info["ns/all"] = ns
+    
+    return info
+
+
+def format_reply(info, keys):
+    ''' Build the reply to GETINFO keys
+    '''
+    for k in keys:
+        if k not in info:
+            return '552 Unrecognized key "%s"\r\n' % (k,)
+        
+    out = []
+    for k in keys:
+        v = info[k]
+        if isinstance(v, list):
+            out.append("250+%s=" % (k,))
+            out += [ "." + l if l.startswith(".") else l for l in v ]
+            out.append(".")
+        else:
+            out.append("250-%s=%s" % (k, v))
+    out.append("250 OK")
+    return "\r\n".join(out) + "\r\n"
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    
+    def handle(self):
+        server = self.server
+        authed = False
+        for raw in self.rfile:
+            line = raw.decode().strip()
+            cmd = line.split(" ")[0].upper()
+            server.commands += 1
+            
+            if server.latency:
+                time.sleep(server.latency)
+                
+            if cmd == "AUTHENTICATE":
+                if line == 'AUTHENTICATE "%s"' % (server.password,):
+                    authed = True
+                    reply = "250 OK\r\n"
+                else:
+                    reply = "515 Authentication failed: Password did not match HashedControlPassword value from configuration\r\n"
+            elif not authed:
+                self.wfile.write(b"514 Authentication required.\r\n")
+                return
+            elif cmd == "GETINFO":
+                reply = format_reply(server.info, line.split(" ")[1:])
+            elif cmd == "SETEVENTS":
+                reply = "250 OK\r\n"
+            elif cmd == "QUIT":
+                self.wfile.write(b"250 closing connection\r\n")
+                return
+            else:
+                reply = '510 Unrecognized command "%s"\r\n' % (cmd,)
+                
+            self.wfile.write(reply.encode())
+
+
+class FakeControlPort(socketserver.ThreadingTCPServer):
+    
+    allow_reuse_address = True
+    daemon_threads = True
+    
+    def __init__(self, address, info, password="MySecretPass", latency=0):
+        super().__init__(address, ControlHandler)
+        self.info = info
+        self.password = password
+        self.latency = latency
+        self.commands = 0
+        
+        
+    def start(self):
+        ''' Serve from a background thread
+        '''
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+
+def add_args(parser):
+    parser.add_argument("--latency", type=float, default=0, help="seconds to wait before each reply")
+    parser.add_argument("--policy-rules", type=int, default=500, help="number of rules in the ipv4 exit policy")
+    parser.add_argument("--circuits", type=int, default=1000, help="number of circuits in circuit-status")
+    parser.add_argument("--relays", type=int, default=7000, help="number of relays in ns/all")
+    parser.add_argument("--password", default="MySecretPass")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake tor control port")
+    parser.add_argument("--port", type=int, default=9051)
+    add_args(parser)
+    args = parser.parse_args()
+    
+    info = build_info(args.policy_rules, args.circuits, args.relays)
+    server = FakeControlPort(("127.0.0.1", args.port), info, args.password, args.latency)
+    print("Listening on 127.0.0.1:%d" % (args.port,))
+    server.serve_forever()
@@ -5,13 +5,22 @@
 # Copyright (c) 2022 B Tasker
 # Released under GNU GPL v3 - https://www.gnu.org/licenses/gpl-3.0.txt
 #
-# Version: 0.2
+# Version: 0.3
 #
 
+import array
+import base64
+import concurrent.futures
 import datetime
+import json
+import math
 import os
+from bisect import bisect_right
+import re
+import select
 import socket
 import sys
+import tempfile
 import time
 
 CONTROL_H = os.getenv("CONTROL_HOST", "127.0.0.1")
@@ -19,6 +28,43 @@ CONTROL_P = int(os.getenv("CONTROL_PORT", 9051))
 AUTH = os.getenv("CONTROL_AUTH", "MySecretPass")
 MEASUREMENT = os.getenv("MEASUREMENT", "tor")
 
+# Poll multiple tor daemons. A comma separated list of host:port:auth
+# (or /path/to/control/socket:auth). If auth is omitted, CONTROL_AUTH is used
+#
+# e.g. CONTROL_TARGETS="127.0.0.1:9051:pass1,127.0.0.1:9052:pass2,/run/tor/control"
+CONTROL_TARGETS = os.getenv("CONTROL_TARGETS", "")
+
+# How long (in seconds) to wait for tor before considering the connection dead
+CONTROL_TIMEOUT = float(os.getenv("CONTROL_TIMEOUT", 10))
+
+# Stay running and keep the control port connection open between
+# collections (for use with Telegraf's inputs.execd)
+EXECD_MODE = os.getenv("EXECD_MODE", "false").lower() == "true"
+
+# In execd mode, collect every n seconds rather than waiting for Telegraf
+# to write to stdin. 0 means wait for stdin
+EXECD_INTERVAL = float(os.getenv("EXECD_INTERVAL", 0))
+
+# In execd mode, subscribe to BW, CIRC and ORCONN events and write a
+# summary of them out each interval
+EVENTS_MODE = os.getenv("TOR_EVENTS", "false").lower() == "true"
+EVENTS_MEASUREMENT = os.getenv("EVENTS_MEASUREMENT", MEASUREMENT + "_events")
+
+# Collect counts of circuits, streams and OR connections by state
+CIRCUIT_STATS = os.getenv("CIRCUIT_STATS", "false").lower() == "true"
+
+# How long (in seconds) to cache values which rarely change. 0 disables caching
+#
+# In execd mode the cache is held in memory, otherwise it's written to disk
+# in CACHE_DIR. That must be a directory only we can write to, the default
+# is a per-user directory within the system temp dir
+CACHE_TTL = int(os.getenv("CACHE_TTL", 3600))
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(tempfile.gettempdir(), f"tor-daemon-{os.getuid()}"))
+
+# Collect network-wide stats from the consensus. ns/all runs to several MB
+# so it's only re-read when a new consensus arrives
+CONSENSUS_STATS = os.getenv("CONSENSUS_STATS", "false").lower() == "true"
+
 # stats to collect
 stats = [
     #cmd, output_name, type, tag/field
@@ -34,59 +80,454 @@ stats = [
     ["network-liveness", "network_liveness", "string", "tag"]
 ]
 
+# Stream states reported by stream-status
+stream_states = ["NEW", "NEWRESOLVE", "REMAP", "SENTCONNECT", "SENTRESOLVE",
+                 "SUCCEEDED", "FAILED", "CLOSED", "DETACHED"]
 
-def send_and_respond(sock, command):
-    ''' Send a command and return a list of response lines
+# Circuits longer than this get counted together in the path length histogram
+max_hops = 6
+
+# Keys whose values (or, for exit policies, the stats derived from them)
+# can be cached
+cached_keys = [
+    "version",
+    "exit-policy/ipv4",
+    "exit-policy/ipv6",
+    "accounting/interval-start",
+    "accounting/interval-end"
+]
+
+# Keys which are only requested once we know they're relevant
+exit_policy_keys = ["exit-policy/ipv4", "exit-policy/ipv6"]
+
+accounting_keys = [
+    "accounting/hibernating",
+    "accounting/bytes",
+    "accounting/bytes-left",
+    "current-time/utc",
+    "accounting/interval-start",
+    "accounting/interval-end"
+]
+
+
+class ControlPortError(Exception):
+    ''' Raised when the control port connection fails or is lost
     '''
-    
-    if not command.endswith('\n'):
-        command += "\n"
+    pass
 
-    a = sock.sendall(command.encode())
 
-    # Read the response
-    res = []
-    read_attempts = 0
-    while True:
+class ControlConnection:
+    ''' A buffered connection to the control port
+    
+    Replies are framed using the grammar in section 2.3 of the control spec
+    
+        MidReplyLine: StatusCode "-" ReplyLine
+        DataReplyLine: StatusCode "+" ReplyLine CmdData   (ends with a lone ".")
+        EndReplyLine: StatusCode " " ReplyLine
+        
+    so we know a reply is complete as soon as its end line arrives, rather than
+    having to wait for a read to time out
+    '''
+    
+    def __init__(self, sock, event_handler=False):
+        self.sock = sock
+        self.buf = bytearray()
+        self.pos = 0
+        
+        # Called with the lines of any asynchronous (650) event we receive
+        self.event_handler = event_handler
+        
+        
+    def send(self, command):
+        ''' Write a command to the control port
+        '''
+        if not command.endswith('\n'):
+            command += "\r\n"
         try:
-            data = sock.recv(1024)
+            self.sock.sendall(command.encode())
+        except socket.error as e:
+            raise ControlPortError(e)
+            
+            
+    def readline(self):
+        ''' Return the next CRLF terminated line (without the CRLF)
+        '''
+        while True:
+            i = self.buf.find(b"\r\n", self.pos)
+            if i > -1:
+                line = self.buf[self.pos:i].decode(errors="replace")
+                self.pos = i + 2
+                return line
+            
+            # Drop whatever we've already consumed and read some more
+            del self.buf[:self.pos]
+            self.pos = 0
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as e:
+                # includes timeouts
+                raise ControlPortError(e)
+
             if not data:
-                break
-            l = data.decode()
-            res.append(l)
-            
-            if l.startswith("250 OK\r\n") or l.endswith("250 OK\r\n"):
-                # We've reached the end of the message
-                break
-            
-        except socket.timeout as e:
-            if e.args[0] == "timed out":
-                if len(res) == 0 and read_attempts < 2 and len(res) == 0:
-                    # Wait a little longer
-                    time.sleep(0.5)
-                    read_attempts += 1
-                    continue
-                else:
-                    # Looks like we got our read
-                    break
+                # The other end has closed the connection
+                # (tor has probably restarted)
+                raise ControlPortError("connection closed")
+            self.buf += data
+            
+            
+    def read_reply(self):
+        ''' Read a full reply, returning a list of its lines
+        
+        Data blocks are returned as-is, including their terminating "."
+        
+        Asynchronous events can arrive before the reply we're waiting for,
+        they're passed to the event handler
+        '''
+        return list(self.iter_reply())
+        
+        
+    def iter_reply(self):
+        ''' Yield the lines of the next reply as they're read
+        
+        Lets large replies be processed without holding the whole thing in memory
+        '''
+        while True:
+            reply = self.iter_any_reply()
+            first = next(reply)
+            if first.startswith("650"):
+                self.dispatch_event([first] + list(reply))
+                continue
+            
+            yield first
+            yield from reply
+            return
+            
+            
+    def dispatch_event(self, lines):
+        ''' Pass an asynchronous event to the handler
+        '''
+        if self.event_handler:
+            self.event_handler(lines)
+            
+            
+    def has_buffered_line(self):
+        ''' Do we have an unread line sitting in the buffer?
+        '''
+        return self.buf.find(b"\r\n", self.pos) > -1
+            
+            
+    def pump_events(self):
+        ''' Read and dispatch whatever events tor has sent us
+        
+        Should only be called when the socket is known to be readable (or
+        there's something in the buffer), otherwise it'll block
+        '''
+        while True:
+            lines = self.read_any_reply()
+            if lines[0].startswith("650"):
+                self.dispatch_event(lines)
+            if not self.has_buffered_line():
+                return
+            
+            
+    def read_any_reply(self):
+        ''' Read the next reply from the socket, whatever it is
+        '''
+        return list(self.iter_any_reply())
+    
+    
+    def iter_any_reply(self):
+        ''' Yield the lines of the next reply from the socket, whatever it is
+        '''
+        while True:
+            line = self.readline()
+            yield line
+            if len(line) < 4:
+                # Shouldn't happen, but we don't want to spin on it
+                continue
+            
+            if line[3] == "+":
+                # Pass through the data block
+                while True:
+                    data = self.readline()
+                    yield data
+                    if data == ".":
+                        break
+            elif line[3] == " ":
+                # End of the reply
+                return
+            
+            
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+def send_and_respond(s, command):
+    ''' Send a command and return a list of response lines
+    
+    Raises ControlPortError if the connection has gone away
+    '''
+    s.send(command)
+    return s.read_reply()
+
+
+def parse_getinfo(res):
+    ''' Parse the lines of a GETINFO response into a dict of key -> value
+    
+    Single line values arrive as 250-key=value, multi-line values as 
+    250+key= followed by a data block terminated by a lone "."
+    
+    Multi-line values are returned with lines delimited by newlines
+    '''
+    info = {}
+    key = False
+    data = []
+    for line in res:
+        if key:
+            # We're inside a data block
+            if line == ".":
+                info[key] = "\n".join(data)
+                key = False
+            elif line.startswith(".."):
+                # dot-stuffed line
+                data.append(line[1:])
             else:
-                # Unhandled error
-                print(e)
-                sys.exit(1)
-        except socket.error as e:
-            print(e)
-            sys.exit(1)
+                data.append(line)
+            continue
+        
+        if line.startswith("250-") and "=" in line:
+            k, v = line[4:].split("=", 1)
+            info[k] = v
+        elif line.startswith("250+"):
+            key = line[4:].split("=", 1)[0]
+            data = []
             
-    return ''.join(res).split('\r\n')
+    return info
 
 
-def get_guard_counts(s):
-    ''' Get guard info and build a set of counters
+def get_info(s, keys):
+    ''' Fetch a list of keys with a single GETINFO command
+    
+    Tor rejects the entire command if any one key is unrecognised or unavailable,
+    so if the batch fails we split it in half and try again. Keys which
+    can't be fetched are absent from the returned dict
+    '''
+    if len(keys) == 0:
+        return {}
     
+    res = send_and_respond(s, "GETINFO " + " ".join(keys))
+    if len(res) > 0 and res[0].startswith("250"):
+        return parse_getinfo(res)
+    
+    info = {}
+    if len(keys) > 1:
+        half = len(keys) // 2
+        info.update(get_info(s, keys[:half]))
+        info.update(get_info(s, keys[half:]))
+    return info
+
+
+def iter_info(s, keys):
+    ''' Fetch a list of keys with a single GETINFO command, yielding
+    (key, line) for each line of the values as they're read off the socket
+    
+    Keys which couldn't be fetched won't be yielded
+    '''
+    s.send("GETINFO " + " ".join(keys))
+    
+    key = False
+    for line in s.iter_reply():
+        if key:
+            # We're inside a data block
+            if line == ".":
+                key = False
+            elif line.startswith(".."):
+                # dot-stuffed line
+                yield key, line[1:]
+            else:
+                yield key, line
+        elif line.startswith("250-") and "=" in line:
+            yield tuple(line[4:].split("=", 1))
+        elif line.startswith("250+"):
+            key = line[4:].split("=", 1)[0]
+
+
+def get_circuit_counts(s, state):
+    ''' Fetch the circuit, stream and OR connection lists and build counters
+    
+    The lists can be long on busy relays, so each row is folded into the counters
+    as it's read rather than collecting the whole reply first
+    
+    https://github.com/torproject/torspec/blob/main/control-spec.txt#L1024
+    '''
+    circ_state = { x.lower() : 0 for x in EventAggregator.circ_states }
+    circ_purpose = {}
+    stream_state = { x.lower() : 0 for x in stream_states }
+    orconn_state = { x.lower() : 0 for x in EventAggregator.orconn_states }
+    
+    # Histogram of circuit path lengths
+    hops = { str(x) : 0 for x in range(0, max_hops) }
+    hops[str(max_hops) + "_plus"] = 0
+    
+    keys = ["circuit-status", "stream-status", "orconn-status"]
+    seen = set()
+    for key, line in iter_info(s, keys):
+        seen.add(key)
+        if len(line) == 0:
+            continue
+        parts = line.split(" ")
+        if len(parts) < 2:
+            continue
+        status = parts[1].lower()
+        
+        if key == "circuit-status":
+            # CircuitID SP CircStatus [SP Path] [SP BUILD_FLAGS=...] [SP PURPOSE=...] ...
+            circ_state[status] = circ_state.get(status, 0) + 1
+            
+            path_len = 0
+            purpose = "unknown"
+            for p in parts[2:]:
+                if p.startswith("$"):
+                    path_len = p.count(",") + 1
+                elif p.startswith("PURPOSE="):
+                    purpose = p[8:].lower()
+                    
+            circ_purpose[purpose] = circ_purpose.get(purpose, 0) + 1
+            if path_len >= max_hops:
+                hops[str(max_hops) + "_plus"] += 1
+            else:
+                hops[str(path_len)] += 1
+            
+        elif key == "stream-status":
+            # StreamID SP StreamStatus SP CircuitID SP Target
+            stream_state[status] = stream_state.get(status, 0) + 1
+            
+        elif key == "orconn-status":
+            # LongName SP ORStatus
+            orconn_state[status] = orconn_state.get(status, 0) + 1
+            
+    state["stats_failures"] += len(keys) - len(seen)
+    
+    if "circuit-status" in seen:
+        state["counters"].append(["circuits", circ_state])
+        state["counters"].append(["circuits_purpose", circ_purpose])
+        state["counters"].append(["circuits_hops", hops])
+    if "stream-status" in seen:
+        state["counters"].append(["streams", stream_state])
+    if "orconn-status" in seen:
+        state["counters"].append(["orconns", orconn_state])
+
+
+def get_consensus_stats(s, state, cache, valid_after):
+    ''' Add network-wide stats derived from the consensus to state
+    
+    These only change when a new consensus arrives, so the results are
+    cached against consensus/valid-after
+    '''
+    if valid_after is None:
+        state["stats_failures"] += 1
+        return
+    
+    res = cache.get_versioned("consensus", valid_after)
+    if res is None:
+        res = process_consensus(s)
+        if not res:
+            state["stats_failures"] += 1
+            return
+        cache.set_versioned("consensus", valid_after, res)
+        
+    state["stats"] += res["stats"]
+    state["counters"].append(["consensus_flag", res["flags"]])
+    
+    
+def process_consensus(s):
+    ''' Stream ns/all off the control port and build stats from it
+    
+    Each router status entry looks like
+    
+        r nickname identity digest published-date published-time IP ORPort DirPort
+        s Flags
+        w Bandwidth=N [Measured=N] [Unmeasured=1]
+    
+    We only keep flag counters and an array of weights
+    
+    https://github.com/torproject/torspec/blob/main/dir-spec.txt#L2406
+    '''
+    # If we're a relay, find out our identity so we can locate ourselves
+    ours = False
+    info = get_info(s, ["fingerprint"])
+    if "fingerprint" in info:
+        # ns/all gives identities as unpadded base64
+        ours = base64.b64encode(bytes.fromhex(info["fingerprint"])).decode().rstrip("=")
+        
+    relays = 0
+    flags = {}
+    weights = array.array("q")
+    our_weight = False
+    is_us = False
+    
+    for key, line in iter_info(s, ["ns/all"]):
+        if line.startswith("r "):
+            relays += 1
+            parts = line.split(" ", 3)
+            is_us = ours and len(parts) > 2 and parts[2] == ours
+        elif line.startswith("s "):
+            for flag in line[2:].split(" "):
+                flag = flag.lower()
+                flags[flag] = flags.get(flag, 0) + 1
+        elif line.startswith("w "):
+            for p in line[2:].split(" "):
+                if p.startswith("Bandwidth="):
+                    weights.append(int(p[10:]))
+                    if is_us:
+                        our_weight = weights[-1]
+                        
+    if relays == 0:
+        return False
+    
+    weights = sorted(weights)
+    vals = [
+        ["consensus_relays", relays],
+        ["consensus_weight_total", sum(weights)],
+        ["consensus_weight_p50", percentile(weights, 50)],
+        ["consensus_weight_p90", percentile(weights, 90)],
+        ["consensus_weight_p99", percentile(weights, 99)],
+        ["consensus_weight_max", weights[-1] if len(weights) > 0 else 0]
+        ]
+    
+    if our_weight is not False:
+        # 1 is the highest weighted relay in the network
+        vals.append(["relay_consensus_weight", our_weight])
+        vals.append(["relay_consensus_weight_rank", len(weights) - bisect_right(weights, our_weight) + 1])
+    
+    stats = []
+    for v in vals:
+        stats.append({
+            "name" : v[0],
+            "type" : "int",
+            "value" : v[1],
+            "fieldtype" : "field"
+        })
+        
+    return {"stats" : stats, "flags" : flags}
+
+
+def percentile(vals, p):
+    ''' Nearest-rank percentile of a sorted list
     '''
-    res = send_and_respond(s, "GETINFO entry-guards")
+    if len(vals) == 0:
+        return 0
+    return vals[max(0, math.ceil(p / 100 * len(vals)) - 1)]
+
+
+def get_guard_counts(info):
+    ''' Get guard info and build a set of counters
     
-    if len(res) < 1 or not res[0].startswith("250+"):
+    '''
+    if "entry-guards" not in info:
         print("failed to get guard info")
         return {}
     else:
@@ -100,7 +541,7 @@ def get_guard_counts(s):
             "total" : 0
             }
         
-        for line in res[0:-2]:
+        for line in info["entry-guards"].split("\n"):
             s = line.split(" ")
             if len(s) < 2:
                 continue
@@ -111,8 +552,9 @@ def get_guard_counts(s):
     return counters
 
 
-def get_exit_policy_stats(s):
-    ''' Get exit policies (if set) and generate stats based on them
+def get_exit_policy_stats(policies):
+    ''' Take processed exit policies (see process_exit_policy()) and generate 
+    stats based on them. Policies which couldn't be fetched should be None
     
     Returns a list of statistics
     
@@ -127,9 +569,8 @@ def get_exit_policy_stats(s):
         "fieldtype" : "tag"
         }
     
-    # Fetch the ipv4 policy
-    res = send_and_respond(s, "GETINFO exit-policy/ipv4")
-    if len(res) < 1 or not res[0].startswith("250"):
+    # Check whether we got an ipv4 policy
+    if policies["exit-policy/ipv4"] is None:
         # We're not a relay
         is_relay["value"] = "0"
         stats.append(is_relay)
@@ -139,7 +580,7 @@ def get_exit_policy_stats(s):
     # We have exit policies of some form
     stats.append(is_relay)
     
-    ipv4_stats = process_exit_policy(res)
+    ipv4_stats = policies["exit-policy/ipv4"]
     
     for stat in ipv4_stats:
         p = {
@@ -151,13 +592,12 @@ def get_exit_policy_stats(s):
         stats.append(p)
         
     # Now do the same for ipv6 policies
-    res = send_and_respond(s, "GETINFO exit-policy/ipv6")
-    if len(res) < 1 or not res[0].startswith("250"):
+    if policies["exit-policy/ipv6"] is None:
         # can't proceed, so return what we've got
         return stats
     
     
-    ipv6_stats = process_exit_policy(res)
+    ipv6_stats = policies["exit-policy/ipv6"]
     for stat in ipv6_stats:
         p = {
             "name" : "ipv6_exit_policy_num_" + stat,
@@ -170,8 +610,22 @@ def get_exit_policy_stats(s):
     return stats
     
     
-def process_exit_policy(policy_lines):
-    ''' Take a policy response line and derive stats from it
+def count_ports(intervals):
+    ''' Count the distinct ports covered by a list of (start, end) port ranges
+    '''
+    total = 0
+    last = 0
+    for start, end in sorted(intervals):
+        if end <= last:
+            # Already covered
+            continue
+        total += end - max(start, last + 1) + 1
+        last = end
+    return total
+
+
+def process_exit_policy(policy):
+    ''' Take a policy value and derive stats from it
     
     Returns a counters dict
     
@@ -181,21 +635,7 @@ def process_exit_policy(policy_lines):
     
     # The result that comes back will vary, sometimes it's single-line
     # sometimes it's multiline
-    lines = []
-    if policy_lines[0].startswith("250+"):
-        # multi-line
-        for line in policy_lines:
-            if line in [".", "250 OK"]:
-                break
-            if "=" in line:
-                # First line
-                lines.append(line.split("=")[1])
-            else:
-                # subsequent lines
-                lines.append(line)
-    else:
-        # single line
-        lines.append(policy_lines[0].split("=")[1])
+    lines = policy.split("\n")
     
     
     # Set up the counters
@@ -226,12 +666,14 @@ def process_exit_policy(policy_lines):
         
         }
     
-    hosts = []
+    # Hosts are tracked in sets, ports as lists of (start, end) intervals
+    # so that ranges don't need expanding
+    hosts = set()
     ports = []
     
     counts = {
-        "accept" : {"hosts" : [], "ports" : []},
-        "reject" : {"hosts" : [], "ports" : []}
+        "accept" : {"hosts" : set(), "ports" : [], "wildcard_port" : False},
+        "reject" : {"hosts" : set(), "ports" : [], "wildcard_port" : False}
         }
     
     for policy_line in lines:
@@ -254,54 +696,58 @@ def process_exit_policy(policy_lines):
             if parts[1].startswith("*"):
                 counters["wildcard"] += 1
                 counters["wildcard_" + mode] += 1
-            elif parts[1].startswith("1") or parts[1].startswith("2"):
+            else:
                 counters["specific"] += 1
                 counters["specific_" + mode] += 1
                 
                 # ipv6 complicates this a touch
                 ip = ":".join(parts[1].split(":")[0:-1])
-                hosts.append(ip)
-                counts[mode]["hosts"].append(ip)
+                hosts.add(ip)
+                counts[mode]["hosts"].add(ip)
 
             port = parts[1].split(":")[-1]
             
             if "-" in port:
-                # It's a range, iterate over it
+                # It's a range
                 counters["port_range"] += 1
-                port_parts = [ int(x) for x in port.split("-") ]
-                while port_parts[0] <= port_parts[1]:
-                    ports.append(port_parts[0])
-                    counts[mode]["ports"].append(port_parts[0])
-                    counters['specific_port'] += 1
-                    counters["specific_port_" + mode] += 1
-                    port_parts[0] += 1
+                start, end = [ int(x) for x in port.split("-") ]
+                ports.append((start, end))
+                counts[mode]["ports"].append((start, end))
+                counters['specific_port'] += end - start + 1
+                counters["specific_port_" + mode] += end - start + 1
                     
+            elif port == "*":
+                counts[mode]["wildcard_port"] = True
+                counters['wildcard_port'] += 1
+                counters["wildcard_port_" + mode] += 1
             else:
-                # Singluar port (or wildcard)
-                ports.append(port)
-                counts[mode]["ports"].append(port)
-                if port == "*":
-                    counters['wildcard_port'] += 1
-                    counters["wildcard_port_" + mode] += 1
-                else:
-                    counters['specific_port'] += 1
-                    counters["specific_port_" + mode] += 1
+                # Singular port
+                ports.append((int(port), int(port)))
+                counts[mode]["ports"].append((int(port), int(port)))
+                counters['specific_port'] += 1
+                counters["specific_port_" + mode] += 1
         
     # Calculate the unique counts
-    counters["unique_hosts"] = len(set(hosts))
-    counters["unique_ports"] = len(set(ports))
-
-    counters["unique_hosts_accept"] = len(set(counts["accept"]["hosts"]))
-    counters["unique_ports_accept"] = len(set(counts["accept"]["ports"]))
-    counters["unique_hosts_reject"] = len(set(counts["accept"]["hosts"]))
-    counters["unique_ports_reject"] = len(set(counts["accept"]["ports"]))
+    #
+    # A wildcard port counts as a single unique entry
+    wildcard_port = counts["accept"]["wildcard_port"] or counts["reject"]["wildcard_port"]
+    counters["unique_hosts"] = len(hosts)
+    counters["unique_ports"] = count_ports(ports) + int(wildcard_port)
 
+    for mode in counts:
+        counters["unique_hosts_" + mode] = len(counts[mode]["hosts"])
+        counters["unique_ports_" + mode] = count_ports(counts[mode]["ports"]) + int(counts[mode]["wildcard_port"])
 
-    
     return counters
     
 
-def get_accounting_info(s):
+def accounting_enabled(info):
+    ''' Check whether tor reported that accounting is enabled
+    '''
+    return "accounting/enabled" in info and int(info["accounting/enabled"]) != 0
+
+
+def get_accounting_info(info):
     
     byte_fields = [
         ["accounting/bytes", "accounting_bytes", "int", "field"],
@@ -317,12 +763,10 @@ def get_accounting_info(s):
         "fieldtype" : "tag"
         }
     
-    res = send_and_respond(s, "GETINFO accounting/enabled")
-    if len(res) < 1 or not res[0].startswith("250-"):
+    if "accounting/enabled" not in info:
         return vals
     
-    v = int(res[0].split("=")[1])
-    if v == 0:
+    if not accounting_enabled(info):
         vals.append(accounting)
         return vals
     
@@ -332,9 +776,8 @@ def get_accounting_info(s):
     vals.append(accounting)
     
     # Current relay state
-    res = send_and_respond(s, "GETINFO accounting/hibernating")
-    if len(res) > 1 and res[0].startswith("250-"):
-            val = res[0].split("=")[1]
+    if "accounting/hibernating" in info:
+            val = info["accounting/hibernating"]
             vals.append({
                     "name" : "accounting_hibernating_state",
                     "type" : "string",
@@ -344,9 +787,8 @@ def get_accounting_info(s):
     
     # bytes
     for f in byte_fields:
-        res = send_and_respond(s, "GETINFO " + f[0])
-        if len(res) > 1 and res[0].startswith("250-"):
-            val = res[0].split("=")[1]
+        if f[0] in info:
+            val = info[f[0]]
             # There's a read and a write value
             cols = val.split(" ")
             
@@ -383,15 +825,13 @@ def get_accounting_info(s):
     nowtimepattern = "%Y-%m-%dT%H:%M:%S"
 
     # Ask Tor what time it thinks it currently is
-    res = send_and_respond(s, "GETINFO current-time/utc")
-    if len(res) > 1 and res[0].startswith("250-"):
-        val = res[0].split("=")[1]
+    if "current-time/utc" in info:
+        val = info["current-time/utc"]
         now = datetime.datetime.strptime(val, nowtimepattern)
     
     # Now ask when the accounting period started
-    res = send_and_respond(s, "GETINFO accounting/interval-start")
-    if len(res) > 1 and res[0].startswith("250-"):
-        val = res[0].split("=")[1]
+    if "accounting/interval-start" in info:
+        val = info["accounting/interval-start"]
         acc_start = datetime.datetime.strptime(val, timepattern)
         
         # subtract from now
@@ -404,9 +844,8 @@ def get_accounting_info(s):
             })
         
     # When does the accounting period end?
-    res = send_and_respond(s, "GETINFO accounting/interval-end")
-    if len(res) > 1 and res[0].startswith("250-"):
-        val = res[0].split("=")[1]
+    if "accounting/interval-end" in info:
+        val = info["accounting/interval-end"]
         acc_stop = datetime.datetime.strptime(val, timepattern)
         
         # subtract now
@@ -480,71 +919,671 @@ def build_lp(measurement_name, state):
     f = ",".join(fields)
     return " ".join([l, f])
 
+
+
+def new_state():
+    ''' Create an empty state object to collect stats into
+    '''
+    return {
+        "conn_status" : "failed",
+        "stats_failures" : 0,
+        "stats" : [],
+        "counters" : [],
+        "tags" : [] # used to track failures etc
+    }
+
+
+def collect_stats(s, state, cache):
+    ''' Run through the stats we want to collect, pushing them into state
     
-state = {
-    "conn_status" : "failed",
-    "stats_failures" : 0,
-    "stats" : [],
-    "counters" : [],
-    "tags" : [] # used to track failures etc
-}
-    
-# Initialise a connection
-try:
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((CONTROL_H, int(CONTROL_P)))
-    # set a read timeout of 0.2s
-    s.settimeout(0.2) 
-except:
-    state["stats_failures"] += 1
-    state["tags"].append(["failure_type", "connection"])
-    print(build_lp(MEASUREMENT, state))
-    sys.exit(1)
-   
-
-# Login
-cmd = 'AUTHENTICATE "' + AUTH + '"'
-res = send_and_respond(s, cmd)       
-if len(res) < 1 or res[0] != "250 OK":
-    # Login failed
-    state["stats_failures"] += 1
-    state["tags"].append(["failure_type", "authentication"])
-    print(build_lp(MEASUREMENT, state))
-    sys.exit(1)
-
-
-# We manage to login
-state["conn_status"] = "success"
-    
-# Otherwise, start collecting stats
-for stat in stats:
-    cmd = "GETINFO " + stat[0]
-    res = send_and_respond(s, cmd)
-    if len(res) < 1 or not res[0].startswith("250-"):
+    Keys are requested in (at most) two batches: those we always want, then
+    those which only make sense depending on the answers to the first. Keys
+    which are in cache aren't requested at all
+    '''
+    cached = cache.get_all(cached_keys)
+    
+    # If the accounting period has rolled over, the cached bounds are stale
+    if "accounting/interval-end" in cached:
+        end = datetime.datetime.strptime(cached["accounting/interval-end"], "%Y-%m-%d %H:%M:%S")
+        if end <= datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None):
+            cached.pop("accounting/interval-start", None)
+            cached.pop("accounting/interval-end", None)
+    
+    skipped = [ stat[0] for stat in stats if stat[0] in cached ]
+    keys = [ stat[0] for stat in stats if stat[0] not in cached ] + ["entry-guards", "accounting/enabled"]
+    if CONSENSUS_STATS:
+        keys.append("consensus/valid-after")
+    info = get_info(s, keys)
+    
+    # If tor has restarted, anything we've cached may be out of date
+    keys = []
+    if "uptime" in info and cache.check_restart(int(info["uptime"])):
+        cached = {}
+        keys += skipped
+
+    state["counters"].append(["guards", get_guard_counts(info)])
+    
+    if CIRCUIT_STATS:
+        get_circuit_counts(s, state)
+
+    # Fetch the conditional keys
+    keys += [ k for k in exit_policy_keys if k not in cached ]
+    if accounting_enabled(info):
+        keys += [ k for k in accounting_keys if k not in cached ]
+    info.update(get_info(s, keys))
+    
+    # Process and cache anything we fetched, use the cache for anything we didn't
+    policies = {}
+    for key in exit_policy_keys:
+        if key not in cached:
+            cached[key] = None
+            if key in info:
+                cached[key] = process_exit_policy(info[key])
+            cache.set(key, cached[key])
+        policies[key] = cached[key]
+        
+    for key in cached_keys:
+        if key in exit_policy_keys:
+            continue
+        if key in cached:
+            info[key] = cached[key]
+        elif key in info:
+            cache.set(key, info[key])
+    
+    for stat in stats:
+        if stat[0] not in info:
+            state["stats_failures"] += 1
+            continue
+        
+        # Otherwise push to the stats list
+        state["stats"].append({
+            "name" : stat[1],
+            "type" : stat[2],
+            "value" : info[stat[0]],
+            "fieldtype" : stat[3]
+        })
+
+    # Get accounting info
+    for v in get_accounting_info(info):
+        state["stats"].append(v)
+
+
+    # Get exit policy info
+    for v in get_exit_policy_stats(policies):
+        state["stats"].append(v)
+        
+    if CONSENSUS_STATS:
+        get_consensus_stats(s, state, cache, info.get("consensus/valid-after"))
+        
+    return state
+
+
+def private_dir(path):
+    ''' Create path if needed and check that nobody else can write to it
+    
+    Raises OSError if it's owned by someone else or is group/world writable
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise OSError(f"{path} is writable by other users")
+    
+    
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_counts(value):
+    return isinstance(value, dict) and all(isinstance(k, str) and is_number(v) for k, v in value.items())
+
+
+def valid_cache_entry(key, entry):
+    ''' Check that a cache entry loaded from disk has the shape that
+    collect_stats and get_consensus_stats would have stored under key
+    '''
+    if not isinstance(entry, list) or len(entry) != 2 or not is_number(entry[0]):
+        return False
+    value = entry[1]
+    
+    if key == "consensus":
+        if not isinstance(value, dict) or not isinstance(value.get("version"), str):
+            return False
+        res = value.get("value")
+        if not isinstance(res, dict) or not is_counts(res.get("flags")) or not isinstance(res.get("stats"), list):
+            return False
+        return all(
+            isinstance(stat, dict) and isinstance(stat.get("name"), str) and stat.get("type") == "int" 
+            and stat.get("fieldtype") == "field" and is_number(stat.get("value"))
+            for stat in res["stats"]
+            )
+    if key in exit_policy_keys:
+        return value is None or is_counts(value)
+    if key in cached_keys:
+        return isinstance(value, str)
+    return False
+
+
+class StatsCache:
+    ''' A TTL cache for values which rarely change
+    
+    Held in memory and, if path is set, persisted to disk between runs
+    '''
+    
+    def __init__(self, ttl, path=False):
+        self.ttl = ttl
+        self.path = path
+        self.entries = {}
+        
+        # When tor started, so that we can tell if it's been restarted
+        self.started = False
+        self.dirty = False
+        self.load()
+        
+        
+    def load(self):
+        # Versioned entries are used even when the TTL disables
+        # caching, so this loads regardless
+        if not self.path:
+            return
+        try:
+            private_dir(os.path.dirname(os.path.abspath(self.path)))
+            with open(self.path, "r") as f:
+                d = json.load(f)
+            if not isinstance(d, dict) or not isinstance(d.get("entries"), dict):
+                return
+            started = d.get("started", False)
+            if started is not False and not is_number(started):
+                return
+            # Whatever's in the file ends up in our output, so drop anything
+            # which doesn't look like what we'd have stored
+            self.entries = { k: v for k, v in d["entries"].items() if valid_cache_entry(k, v) }
+            self.started = started
+        except (OSError, ValueError):
+            # Missing, corrupt or somewhere we can't trust, start afresh
+            pass
+        
+        
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        
+        # Write to a temporary file and then move it into place so that
+        # a concurrent run can't read a partial file
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            private_dir(directory)
+            fd, tmp = tempfile.mkstemp(dir=directory)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"entries" : self.entries, "started" : self.started}, f)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        
+        
+    def get_all(self, keys):
+        ''' Return a dict of the unexpired entries for keys
+        '''
+        res = {}
+        if self.ttl <= 0:
+            return res
+        
+        now = time.time()
+        for key in keys:
+            if key in self.entries and (now - self.entries[key][0]) < self.ttl:
+                res[key] = self.entries[key][1]
+        return res
+    
+    
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = [time.time(), value]
+        self.dirty = True
+        
+        
+    def get_versioned(self, key, version):
+        ''' Return the entry for key if it was stored against version, 
+        regardless of TTL. Otherwise, returns None
+        '''
+        if key in self.entries and self.entries[key][1]["version"] == version:
+            return self.entries[key][1]["value"]
+        return None
+    
+    
+    def set_versioned(self, key, version, value):
+        ''' Store value against version
+        
+        This happens even if caching is disabled: the entry can only 
+        be used while version is current, so doesn't need to expire
+        '''
+        self.entries[key] = [time.time(), {"version" : version, "value" : value}]
+        self.dirty = True
+        
+        
+    def invalidate(self):
+        if len(self.entries) > 0:
+            self.entries = {}
+            self.dirty = True
+            
+            
+    def check_restart(self, uptime):
+        ''' Work out when tor started and invalidate the cache if that's 
+        changed since we last looked
+        
+        Returns True if the cache was invalidated
+        '''
+        started = time.time() - uptime
+        if self.started and abs(started - self.started) < 30:
+            # Allow a little slack for the time taken to collect
+            return False
+        
+        restarted = self.started is not False
+        self.started = started
+        self.dirty = True
+        if restarted:
+            self.invalidate()
+        return restarted
+
+
+class EventAggregator:
+    ''' Aggregate BW, CIRC and ORCONN events in memory until they're flushed
+    
+    https://github.com/torproject/torspec/blob/main/control-spec.txt#L2316
+    '''
+    
+    events = ["BW", "CIRC", "ORCONN"]
+    
+    circ_states = ["LAUNCHED", "BUILT", "GUARD_WAIT", "EXTENDED", "FAILED", "CLOSED"]
+    orconn_states = ["NEW", "LAUNCHED", "CONNECTED", "FAILED", "CLOSED"]
+    
+    def __init__(self):
+        self.reset()
+        
+        
+    def reset(self):
+        self.started = time.time()
+        self.bytes_rx = 0
+        self.bytes_tx = 0
+        self.peak_rx = 0
+        self.peak_tx = 0
+        self.bw_events = 0
+        self.circ = { x.lower() : 0 for x in self.circ_states }
+        self.orconn = { x.lower() : 0 for x in self.orconn_states }
+        
+        
+    def handle(self, lines):
+        ''' Fold an event into the counters
+        '''
+        parts = lines[0][4:].split(" ")
+        if len(parts) < 3:
+            return
+        
+        if parts[0] == "BW":
+            # 650 BW BytesRead BytesWritten
+            # sent once a second
+            rx = int(parts[1])
+            tx = int(parts[2])
+            self.bytes_rx += rx
+            self.bytes_tx += tx
+            self.peak_rx = max(self.peak_rx, rx)
+            self.peak_tx = max(self.peak_tx, tx)
+            self.bw_events += 1
+        elif parts[0] == "CIRC":
+            # 650 CIRC CircuitID CircStatus [Path] ...
+            status = parts[2].lower()
+            self.circ[status] = self.circ.get(status, 0) + 1
+        elif parts[0] == "ORCONN":
+            # 650 ORCONN Target ORStatus ...
+            status = parts[2].lower()
+            self.orconn[status] = self.orconn.get(status, 0) + 1
+            
+            
+    def flush(self, measurement_name, tags=[]):
+        ''' Build line protocol from the counters and then reset them
+        '''
+        state = new_state()
+        state["conn_status"] = "success"
+        state["tags"] += tags
+        
+        fields = [
+            ["bytes_rx", self.bytes_rx],
+            ["bytes_tx", self.bytes_tx],
+            ["peak_bytes_rx_per_sec", self.peak_rx],
+            ["peak_bytes_tx_per_sec", self.peak_tx],
+            ["bw_seconds", self.bw_events]
+        ]
+        for f in fields:
+            state["stats"].append({
+                "name" : f[0],
+                "type" : "int",
+                "value" : f[1],
+                "fieldtype" : "field"
+            })
+            
+        state["stats"].append({
+            "name" : "interval_seconds",
+            "type" : "float",
+            "value" : str(round(time.time() - self.started, 3)),
+            "fieldtype" : "field"
+        })
+        
+        state["counters"].append(["circ", self.circ])
+        state["counters"].append(["orconn", self.orconn])
+        
+        self.reset()
+        return build_lp(measurement_name, state)
+
+
+class TorInstance:
+    ''' A tor daemon and our (possibly long-lived) connection to its control port
+    '''
+    
+    def __init__(self, host, port, auth, name=False):
+        ''' If host is a path, it'll be treated as a control socket
+        
+        If name is set, an instance tag will be added to our output
+        '''
+        self.host = host
+        self.port = int(port)
+        self.auth = auth
+        self.conn = False
+        
+        self.tags = []
+        if name:
+            self.tags.append(["instance", name.replace(" ", "\\ ").replace(",", "\\,")])
+            
+        # Cache slow changing values on disk between runs
+        cache_name = re.sub("[^A-Za-z0-9]+", "_", name if name else host + ":" + str(port))
+        self.cache = StatsCache(CACHE_TTL, os.path.join(CACHE_DIR, "tor-daemon-cache-" + cache_name + ".json"))
+        
+        # Events to subscribe to, and something to aggregate them
+        self.events = []
+        self.aggregator = False
+        
+        
+    def enable_events(self):
+        ''' Subscribe to events so they can be aggregated between collections
+        '''
+        self.aggregator = EventAggregator()
+        self.events += self.aggregator.events
+        
+        
+    def use_memory_cache(self):
+        ''' Keep the cache in memory rather than on disk, and watch for
+        events which mean it should be invalidated
+        '''
+        self.cache.path = False
+        if CACHE_TTL > 0:
+            self.events += ["CONF_CHANGED", "SIGNAL"]
+        
+        
+    def handle_event(self, lines):
+        ''' Receive asynchronous events from the control port
+        '''
+        parts = lines[0][4:].split(" ")
+        if parts[0] == "CONF_CHANGED" or (parts[0] == "SIGNAL" and parts[1] == "RELOAD"):
+            # tor's config has changed, so cached values may be wrong
+            self.cache.invalidate()
+            
+        if self.aggregator:
+            self.aggregator.handle(lines)
+        
+        
+    def connect(self):
+        ''' Connect and authenticate to the control port
+        
+        Returns False on success, otherwise the type of failure
+        '''
+        self.close()
+        try:
+            if self.host.startswith("/"):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(CONTROL_TIMEOUT)
+                sock.connect(self.host)
+            else:
+                sock = socket.create_connection((self.host, self.port), CONTROL_TIMEOUT)
+        except:
+            return "connection"
+        
+        s = ControlConnection(sock, self.handle_event)
+
+        # Login
+        cmd = 'AUTHENTICATE "' + self.auth + '"'
+        try:
+            res = send_and_respond(s, cmd)
+        except ControlPortError:
+            s.close()
+            return "connection"
+        
+        if len(res) < 1 or res[0] != "250 OK":
+            # Login failed
+            s.close()
+            return "authentication"
+        
+        if len(self.events) > 0:
+            try:
+                res = send_and_respond(s, "SETEVENTS " + " ".join(self.events))
+            except ControlPortError:
+                s.close()
+                return "connection"
+            if len(res) < 1 or res[0] != "250 OK":
+                s.close()
+                return "events"
+        
+        self.conn = s
+        return False
+    
+    
+    def close(self):
+        ''' Close the control port connection (if open)
+        '''
+        if self.conn:
+            self.conn.close()
+        self.conn = False
+        
+        
+    def poll(self):
+        ''' Collect stats and return line protocol
+        
+        If the connection drops part way through (for example because tor
+        restarted) we reconnect and try once more
+        '''
+        failure = "connection"
+        for attempt in range(2):
+            state = new_state()
+            state["tags"] += self.tags
+            if not self.conn:
+                failure = self.connect()
+                if failure:
+                    break
+            
+            # We managed to login
+            state["conn_status"] = "success"
+            try:
+                collect_stats(self.conn, state, self.cache)
+                self.cache.save()
+                return build_lp(MEASUREMENT, state)
+            except ControlPortError:
+                self.close()
+                failure = "connection"
+
+        state = new_state()
         state["stats_failures"] += 1
-        continue
+        state["tags"].append(["failure_type", failure])
+        state["tags"] += self.tags
+        return build_lp(MEASUREMENT, state)
+        
+        
+    def flush_events(self):
+        ''' Return line protocol for the events received since the last flush
+        '''
+        return self.aggregator.flush(EVENTS_MEASUREMENT, self.tags)
+
+
+def parse_targets(targets):
+    ''' Turn the CONTROL_TARGETS string into a list of TorInstances
     
-    # Otherwise push to the stats list
-    val = res[0].split("=")[1]
+    Each target is host:port[:auth] or /path/to/socket[:auth]. IPv6
+    addresses should be wrapped in brackets - [::1]:9051:auth
+    '''
+    instances = []
+    for target in targets.split(","):
+        target = target.strip()
+        if len(target) == 0:
+            continue
+        
+        if target.startswith("/"):
+            parts = target.split(":", 1)
+            host, port = parts[0], 0
+            name = host
+            auth = parts[1] if len(parts) > 1 else AUTH
+        else:
+            if target.startswith("["):
+                host, rest = target[1:].split("]", 1)
+                parts = rest.lstrip(":").split(":", 1)
+                name = "[" + host + "]:" + parts[0]
+            else:
+                host, rest = target.split(":", 1)
+                parts = rest.split(":", 1)
+                name = host + ":" + parts[0]
+            port = parts[0]
+            auth = parts[1] if len(parts) > 1 else AUTH
+            
+        instances.append(TorInstance(host, port, auth, name))
+        
+    return instances
+
+
+def poll_all(instances):
+    ''' Poll each of the tor instances, concurrently if there's more than one
     
-    state["stats"].append({
-        "name" : stat[1],
-        "type" : stat[2],
-        "value" : val,
-        "fieldtype" : stat[3]
-    })
+    Returns a list of lines of line protocol
+    '''
+    if len(instances) == 1:
+        return [ instances[0].poll() ]
     
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(instances)) as pool:
+        return list(pool.map(TorInstance.poll, instances))
 
-state["counters"].append(["guards", get_guard_counts(s)])
 
-# Get accounting info
-for v in get_accounting_info(s):
-    state["stats"].append(v)
+def wait_for_trigger(instances, timeout):
+    ''' Wait until it's time to collect, servicing the control ports meanwhile
+    
+    If timeout is None, we wait for Telegraf to write to stdin, otherwise
+    we wait timeout seconds
+    
+    Returns False if stdin has been closed
+    '''
+    deadline = False
+    if timeout is not None:
+        deadline = time.time() + timeout
+    
+    while True:
+        watch = []
+        if not deadline:
+            watch.append(sys.stdin)
+            
+        for tor in instances:
+            if not tor.conn:
+                continue
+            
+            if tor.conn.has_buffered_line():
+                # Events left over from the last command
+                pump_events(tor)
+            
+            if tor.conn:
+                watch.append(tor.conn.sock)
 
+        wait = None
+        if deadline:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return True
+            
+        readable, w, x = select.select(watch, [], [], wait)
+        for r in readable:
+            if r is sys.stdin:
+                # We read the fd directly so that python doesn't buffer
+                # triggers that select() won't then tell us about
+                if len(os.read(sys.stdin.fileno(), 4096)) == 0:
+                    # stdin closed, Telegraf has gone away
+                    return False
+                return True
+            
+            # tor has sent us something
+            for tor in instances:
+                if tor.conn and tor.conn.sock is r:
+                    pump_events(tor)
+
+
+def pump_events(tor):
+    ''' Process whatever events a tor instance has sent us
+    '''
+    try:
+        tor.conn.pump_events()
+    except ControlPortError:
+        # we'll reconnect at the next collection
+        tor.close()
+                
+
+def run_execd(instances):
+    ''' Stay resident, emitting lines each time Telegraf writes to stdin
+    (or every EXECD_INTERVAL seconds, if set)
+    '''
+    for tor in instances:
+        tor.use_memory_cache()
+        if EVENTS_MODE:
+            tor.enable_events()
+        
+        # Connect up front so that we're receiving events before the first
+        # collection. If it fails, poll() will retry
+        tor.connect()
+    
+    timeout = None
+    next_run = time.time()
+    while True:
+        if EXECD_INTERVAL > 0:
+            # If we've fallen behind, don't try to catch up
+            next_run = max(next_run, time.time())
+            timeout = next_run - time.time()
+            next_run += EXECD_INTERVAL
+            
+        if not wait_for_trigger(instances, timeout):
+            break
+        
+        lines = poll_all(instances)
+        for tor in instances:
+            if tor.aggregator:
+                lines.append(tor.flush_events())
+        print("\n".join(lines), flush=True)
+            
+    for tor in instances:
+        tor.close()
 
-# Get exit policy info
-for v in get_exit_policy_stats(s):
-    state["stats"].append(v)
 
-#print(state)
-print(build_lp(MEASUREMENT, state))
+if __name__ == "__main__":
+    if CONTROL_TARGETS:
+        instances = parse_targets(CONTROL_TARGETS)
+    else:
+        instances = [ TorInstance(CONTROL_H, CONTROL_P, AUTH) ]
+    
+    if EXECD_MODE or "--execd" in sys.argv:
+        run_execd(instances)
+        sys.exit(0)
+    
+    print("\n".join(poll_all(instances)))
+    
+    connected = [ tor for tor in instances if tor.conn ]
+    for tor in connected:
+        tor.close()
+        
+    if len(connected) == 0:
+        # We failed to connect or login
+        sys.exit(1)